@@ -0,0 +1,32 @@
+"""Benchmarks the least squares backends (the built-in Levenberg-Marquardt
+and scipy.optimize.least_squares) on synthetic fits
+
+Usage: python benchmarks/bench_backends.py [nPoints] [K]
+"""
+from common import SEED, FITS, argument, synthetic_data, timed
+from gpfit.fit import fit
+
+NPT = argument(1, 5000)
+K = argument(2, 4)
+x, y = synthetic_data(NPT)
+CONFIGS = [
+    ("lm", "dense"),
+    ("lm", "sparse"),
+    ("lm", "structured"),
+    ("scipy-trf", "dense"),
+    ("scipy-trf", "sparse"),
+    ("scipy-trf", "structured"),
+    ("scipy-lm", "dense"),
+]
+
+print(f"{NPT} points, K = {K}\n")
+print(f"{'fit':>5} {'solver':>10} {'jacobian':>11} {'time [s]':>10} "
+      f"{'rms_rel':>10}")
+for fit_type, fitclass in FITS.items():
+    for solver, jacobian_type in CONFIGS:
+        if jacobian_type not in fitclass.jacobian_types:
+            continue
+        f, elapsed = timed(fit, x, y, K, fit_type=fit_type, seed=SEED,
+                           solver=solver, jacobian_type=jacobian_type)
+        print(f"{fit_type:>5} {solver:>10} {jacobian_type:>11} "
+              f"{elapsed:10.3g} {f.errors['rms_rel']:10.3g}")
@@ -0,0 +1,33 @@
+"""Benchmarks the levenberg_marquardt damping strategies, scalings and
+geodesic acceleration on synthetic fits, counting accepted and rejected steps
+
+Usage: python benchmarks/bench_damping.py [nPoints] [K]
+"""
+from common import SEED, FITS, argument, synthetic_data, timed
+from gpfit.maths.least_squares import levenberg_marquardt
+
+NPT = argument(1, 5000)
+K = argument(2, 4)
+x, y = synthetic_data(NPT)
+CONFIGS = [
+    ("classic", "marquardt", False),
+    ("nielsen", "marquardt", False),
+    ("classic", "levenberg", False),
+    ("nielsen", "levenberg", False),
+    ("classic", "marquardt", True),
+    ("nielsen", "marquardt", True),
+]
+
+print(f"{NPT} points, K = {K}\n")
+print(f"{'fit':>5} {'damping':>8} {'scaling':>10} {'geodesic':>9} {'accepted':>9} "
+      f"{'rejected':>9} {'time [s]':>9} {'rms':>10}")
+for fit_type, fitclass in FITS.items():
+    # a fit with no iterations holds the initial parameters
+    f = fitclass(x, y, K, seed=SEED, solver_options={"maxiter": 0})
+    for damping, scaling, geodesic in CONFIGS:
+        (params, rmstraj, info), elapsed = timed(
+            levenberg_marquardt, f.residual, f.params, damping=damping,
+            scaling=scaling, geodesic=geodesic, full_output=True, maxiter=2000)
+        print(f"{fit_type:>5} {damping:>8} {scaling:>10} {str(geodesic):>9} "
+              f"{info['accepted']:9d} {info['rejected']:9d} {elapsed:9.3g} "
+              f"{rmstraj.min():10.4g}")
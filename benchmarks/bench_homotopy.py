@@ -0,0 +1,40 @@
+"""Benchmarks the softness continuation of SoftmaxAffine against the joint
+solve from alpha0, counting residual evaluations (every trial point) and
+Jacobian evaluations (every accepted point) of levenberg_marquardt
+
+Usage: python benchmarks/bench_homotopy.py [nPoints] [nSeeds]
+"""
+from common import argument, synthetic_data, timed
+from gpfit.fit import SoftmaxAffine
+
+NPT = argument(1, 5000)
+NSEEDS = argument(2, 2)
+x, y = synthetic_data(NPT)
+
+
+class CountingSoftmaxAffine(SoftmaxAffine):
+    """SoftmaxAffine that counts its residual and Jacobian evaluations"""
+    counts = {"residual": 0, "jacobian": 0}
+
+    def _residual(self, params):
+        self.counts["residual"] += 1
+        return super()._residual(params)
+
+    def _jacobian(self, params):
+        self.counts["jacobian"] += 1
+        return super()._jacobian(params)
+
+
+print(f"{NPT} points\n")
+print(f"{'K':>3} {'seed':>5} {'solver':>9} {'residuals':>10} {'jacobians':>10} "
+      f"{'time [s]':>9} {'rms_rel':>10}")
+for K in [2, 3, 4, 6]:
+    for seed in range(1, NSEEDS + 1):
+        for solver in ["lm", "homotopy"]:
+            CountingSoftmaxAffine.counts.update(residual=0, jacobian=0)
+            f, elapsed = timed(CountingSoftmaxAffine, x, y, K, seed=seed,
+                               solver=solver)
+            counts = CountingSoftmaxAffine.counts
+            print(f"{K:3d} {seed:5d} {solver:>9} {counts['residual']:10d} "
+                  f"{counts['jacobian']:10d} {elapsed:9.3g} "
+                  f"{f.errors['rms_rel']:10.3g}")
@@ -0,0 +1,31 @@
+"""Benchmarks the levenberg_marquardt step solvers on synthetic fits
+
+Usage: python benchmarks/bench_step_solvers.py [nPoints] [K]
+"""
+from common import SEED, FITS, argument, synthetic_data, timed
+from gpfit.fit import fit
+
+NPT = argument(1, 20000)
+K = argument(2, 4)
+x, y = synthetic_data(NPT)
+CONFIGS = [
+    ("lstsq", "dense"),
+    ("svd", "dense"),
+    ("cholesky", "dense"),
+    ("cholesky", "structured"),
+    ("sparse", "sparse"),
+]
+
+print(f"{NPT} points, K = {K}\n")
+print(f"{'fit':>5} {'step_solver':>12} {'jacobian':>11} {'time [s]':>10} "
+      f"{'rms_rel':>10}")
+for fit_type in ["ma", "sma", "isma"]:
+    for step_solver, jacobian_type in CONFIGS:
+        if jacobian_type not in FITS[fit_type].jacobian_types:
+            continue
+        f, elapsed = timed(fit, x, y, K, fit_type=fit_type, seed=SEED,
+                           jacobian_type=jacobian_type,
+                           solver_options={"step_solver": step_solver,
+                                           "maxiter": 200})
+        print(f"{fit_type:>5} {step_solver:>12} {jacobian_type:>11} "
+              f"{elapsed:10.3g} {f.errors['rms_rel']:10.3g}")
@@ -0,0 +1,34 @@
+"""Synthetic data and timing shared by the benchmark scripts
+
+The scripts are run as python benchmarks/bench_<name>.py, which puts this
+directory on the import path.
+"""
+import sys
+from time import time
+import numpy as np
+from gpfit.fit import MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine
+
+SEED = 33404
+FITS = {"ma": MaxAffine, "sma": SoftmaxAffine, "isma": ImplicitSoftmaxAffine}
+
+
+def argument(index, default):
+    """Integer command line argument index, or default if not given"""
+    return int(sys.argv[index]) if len(sys.argv) > index else default
+
+
+def synthetic_data(npt, seed=SEED):
+    """Log of the power of a transistor-like model over random supply and
+    threshold voltages: x [2 x npt] and y [npt], in the layout of fit"""
+    rng = np.random.RandomState(seed)
+    Vdd = rng.random_sample(npt) + 1
+    Vth = 0.2*rng.random_sample(npt) + 0.2
+    P = Vdd**2 + 30*Vdd*np.exp(-(Vth - 0.06*Vdd)/0.039)
+    return np.log(np.vstack((Vdd, Vth))), np.log(P)
+
+
+def timed(function, *args, **kwargs):
+    """function(*args, **kwargs), and its wall time in seconds"""
+    t = time()
+    result = function(*args, **kwargs)
+    return result, time() - t
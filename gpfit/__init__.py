@@ -1,4 +1,4 @@
 "Package for GP-compatible data fitting"
 __version__ = "0.2.0"
 
-from .fit import fit
+from .fit import fit, fit_multistart, fit_sweep, fit_coreset
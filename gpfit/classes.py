@@ -1,21 +1,59 @@
 """The fit classes (both in the python sense and the mathematical sense)"""
+# pylint: disable=too-many-lines
 import pickle
+from time import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib.colors import Normalize
 from .maths.least_squares import levenberg_marquardt
+from .maths.backends import BACKENDS
+from .maths.partition import max_affine_partition
 from .maths.initialize import get_initial_parameters
 from .maths.logsumexp import lse_scaled, lse_implicit
+from .maths.workspace import Workspace
+from .maths.streaming import StreamedLeastSquares, ParallelLeastSquares
+from .maths.jacobian import KhatriRaoJacobian, CHUNK_ELEMENTS
 from .constraint_set import FitConstraintSet
 
+# Maximum number of points evaluated at once by predict and predict_log
+PREDICT_CHUNKSIZE = 2**16
+# Default memory budget (bytes) of evaluate_chunked, shared by its threads
+EVALUATE_MAX_BYTES = 2**28
+# Approximate number of temporaries per point and parameter allocated by
+# _evaluate_y (z, h, exponentials, derivatives); the dense Jacobian adds two
+EVALUATE_TEMPORARIES = 6
+# Factor by which successive batches of a coarse-to-fine solve grow
+BATCH_GROWTH = 4
+# Loosest tolrms, and most iterations, used for the batches before the
+# full-data solve
+BATCH_TOLRMS = 1e-5
+BATCH_MAXITER = 100
+# Softness continuation of SoftmaxAffine: first softness, relative to the
+# initial one, factor between stages, and loosest tolrms and most iterations
+# of each fixed-softness stage
+HOMOTOPY_START = 1e-3
+HOMOTOPY_GROWTH = 4
+HOMOTOPY_TOLRMS = 1e-5
+HOMOTOPY_MAXITER = 100
+
 
 # pylint: disable=too-many-locals
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-branches
+# pylint: disable=too-many-statements
 class _Fit:
     """The base class for GPfit"""
-    def __init__(self, xdata, ydata, K, alpha0=10, verbosity=0, seed=None):
+    jacobian_types = ("dense",)
+    solvers = tuple(BACKENDS)
+
+    def __init__(self, xdata, ydata, K, alpha0=10, verbosity=0, seed=None,
+                 solver_options=None, jacobian_type="dense", params0=None,
+                 init="random", chunksize=None, workers=None, batchsize=None,
+                 weights=None, solver="lm", callback=None):
         """Initialize _Fit object
 
         Arguments
@@ -38,53 +76,526 @@ class _Fit:
         seed: None or int
             Seed for random number generator in initialization function
 
+        solver_options: None or dict
+            Keyword arguments passed on to the solver
+            (e.g. {"step_solver": "svd"} for levenberg_marquardt)
+
+        jacobian_type: str
+            Jacobian representation used while fitting, one of
+            jacobian_types. "structured" (SoftmaxAffine and
+            ImplicitSoftmaxAffine) avoids materializing the
+            nPoints x K(nDim + 1) Jacobian block; "sparse" (MaxAffine) builds
+            a CSR Jacobian with nDim + 1 nonzeros per row
+
+        params0: None, 1D numpy array or Fit object
+            Initial fit parameters, laid out as the params attribute, or a
+            fit of the same type whose params are used (a warm start). If
+            None, they are initialized from get_initial_parameters and alpha0
+
+        init: str ("random", "kmeans++")
+            How get_initial_parameters picks its partition centers
+
+        chunksize: None or int
+            If given, the data is streamed chunksize points at a time rather
+            than held in memory, so xdata and ydata may be memmaps or paths
+            to .npy files (opened with mmap_mode="r"). The initialization
+            uses a random sample of about chunksize points, the solver works
+            on normal equations accumulated over the chunks (see
+            gpfit.maths.streaming), and jacobian_type is ignored. Geodesic
+            acceleration (solver_options) is not available
+
+        workers: None or int
+            If given, the data is copied into shared memory and each solver
+            pass over it is split between this many worker processes (see
+            gpfit.maths.streaming.ParallelLeastSquares); jacobian_type is
+            ignored, and, as with chunksize, geodesic acceleration is not
+            available
+
+        batchsize: None or int
+            If given, the solve is coarse-to-fine: it starts on a random
+            subset of batchsize points, which grows by BATCH_GROWTH per stage
+            and is solved with tolrms of at least BATCH_TOLRMS, and it
+            finishes on the full data (see _solve_batches)
+
+        weights: None or 1D numpy array [nPoints,]
+            Nonnegative weight of each point (e.g. its multiplicity, see
+            gpfit.maths.coalesce). The fit minimizes the weighted sum of
+            squared log errors, and the RMS errors are weighted means
+
+        solver: str
+            Solver, one of solvers. "lm" is levenberg_marquardt, and
+            "scipy-trf" and "scipy-lm" are scipy.optimize.least_squares with
+            method "trf" or "lm" (see gpfit.maths.backends); "partition"
+            (MaxAffine) is max_affine_partition, which refits each affine
+            term to the points where it is active until the partition is
+            stable; "homotopy" (SoftmaxAffine) first solves a sequence of
+            fixed-softness problems (see SoftmaxAffine._solve_homotopy), then
+            levenberg_marquardt. Only "lm" can stream the data (chunksize)
+            or split it between workers
+
+        callback: None or function
+            Called after every solver iteration with a dict describing it
+            (see levenberg_marquardt); if it returns True, the solve stops
+            and the fit keeps the parameters reached so far. The solve is
+            described by the solve_report attribute (see _solve)
+
         """
 
+        if chunksize is not None:
+            xdata, ydata, weights = (np.load(data, mmap_mode="r") if isinstance(data, str)
+                                     else data for data in (xdata, ydata, weights))
         if ydata.ndim > 1:
             raise ValueError("Dependent data should be a 1D numpy array")
+        if weights is not None:
+            if chunksize is None:
+                weights = np.asarray(weights, dtype=float)
+            if weights.shape != ydata.shape:
+                raise ValueError("weights should have one element per data point")
+            if np.any(weights < 0):
+                raise ValueError("weights should be nonnegative")
+        if jacobian_type not in self.jacobian_types:
+            raise ValueError(f"{type(self).__name__} jacobian_type should be "
+                             f"one of {self.jacobian_types}")
+        if solver not in self.solvers:
+            raise ValueError(f"{type(self).__name__} solver should be one of "
+                             f"{self.solvers}")
+        if solver != "lm" and (chunksize is not None or workers is not None):
+            raise ValueError(f"solver '{solver}' needs the data in memory")
+        if (solver_options or {}).get("geodesic") and (chunksize is not None
+                                                       or workers is not None):
+            # the compressed residuals of trial points are not comparable
+            raise ValueError("geodesic acceleration needs the data in memory")
 
         self.ydata = ydata
         self.xdata = xdata = xdata.reshape(xdata.size, 1) if xdata.ndim == 1 else xdata.T
         self.d = d = int(xdata.shape[1])  # Number of dimensions
         self.K = K
         self.type = type(self).__name__
+        self.solver_options = dict(solver_options or {})
+        self.jacobian_type = jacobian_type
+        self.solver = solver
+        self.chunksize = chunksize
+        self.workers = workers
+        self.batchsize = batchsize
+        self.weights = weights
+        self._batch_seed = seed
         self.parameters = {"alpha0": alpha0}
         self.bounds = {}
         if d == 1:
-            self.bounds["lb0"] = np.exp(min(xdata.reshape(xdata.size)))
-            self.bounds["ub0"] = np.exp(max(xdata.reshape(xdata.size)))
+            self.bounds["lb0"] = np.exp(np.min(xdata))
+            self.bounds["ub0"] = np.exp(np.max(xdata))
         else:
             for i in range(d):
-                self.bounds[f"lb{i}"] = np.exp(min(xdata.T[i]))
-                self.bounds[f"ub{i}"] = np.exp(max(xdata.T[i]))
-
-        ba = get_initial_parameters(xdata, ydata.reshape(self.ydata.size, 1),
-                                    K, seed).flatten("F")
-        self.A, self.B, self.alpha, self.params = self.get_parameters(ba, K, d)
-
-        yhat = self.evaluate(xdata, self.params)[0]
-        yerror = yhat - ydata
-        what = np.exp(yhat)
-        wdata = np.exp(self.ydata)
-        werror = what - wdata
-        self.errors = {
-            "rms_log": np.sqrt(np.mean(np.square(yerror))),
-            "rms_abs": np.sqrt(np.mean(np.square(werror))),
-            "rms_rel": np.sqrt(np.mean(np.square(werror/wdata))),
-            "max_abs": max(abs(werror)),
-            "max_rel": max(abs(werror/wdata)),
-        }
+                self.bounds[f"lb{i}"] = np.exp(np.min(xdata.T[i]))
+                self.bounds[f"ub{i}"] = np.exp(np.max(xdata.T[i]))
+
+        if params0 is None:
+            xinit, yinit, winit = xdata, ydata, weights
+            if chunksize is not None and ydata.size > chunksize:
+                sample = np.unique(np.random.RandomState(seed).randint(
+                    ydata.size, size=chunksize))
+                xinit, yinit = np.asarray(xdata[sample]), np.asarray(ydata[sample])
+                winit = None if weights is None else np.asarray(weights[sample])
+            ba = get_initial_parameters(xinit, yinit.reshape(yinit.size, 1),
+                                        K, seed, init, winit).flatten("F")
+            params0 = self._default_params(ba, K)
+        else:
+            if isinstance(params0, _Fit):
+                if params0.type != self.type:
+                    raise ValueError(f"Cannot warm-start a {self.type} fit "
+                                     f"from a {params0.type} fit")
+                params0 = params0.params
+            params0 = np.array(params0, dtype=float).ravel()
+            nparam = self._default_params(np.zeros(K*(d + 1)), K).size
+            if params0.size != nparam:
+                raise ValueError(f"params0 should have {nparam} elements for a "
+                                 f"{K}-term {self.type} fit in {d} dimensions")
+        self._cache = None
+        self._workspace = (Workspace(xdata) if chunksize is None and workers is None
+                           else None)
+        self._callback, self._stages, self.solve_report = callback, [], None
+        self.A, self.B, self.alpha, self.params = self.get_parameters(params0, K, d)
+        # drop intermediates, buffers and the callback, which are only needed
+        # while solving
+        self._cache = self._workspace = self._callback = self._stages = None
+
+        self.errors = self._compute_errors()
         self.error = self.errors["rms_rel"]
 
         if verbosity >= 1:
             self.print_result()
 
+    def errors_on(self, xdata, ydata, weights=None):
+        """Errors of the fit on other data, e.g. a validation set
+
+        Arguments
+        ---------
+        xdata, ydata, weights:
+            Data, laid out as for __init__
+
+        Returns
+        -------
+        dict
+            Errors, with the same keys as the errors attribute
+
+        """
+        xdata = np.asarray(xdata, dtype=float)
+        xdata = xdata.reshape(xdata.size, 1) if xdata.ndim == 1 else xdata.T
+        return self._compute_errors(xdata, ydata, weights,
+                                    self.chunksize or PREDICT_CHUNKSIZE)
+
+    def _compute_errors(self, xdata=None, ydata=None, weights=None, chunksize=None):
+        """RMS and maximum errors of the fit, accumulated over chunks of
+        chunksize points (default: the fit's chunksize, or all points)
+
+        Without data, these are the errors on the fit's own data. With
+        weights, the RMS errors are weighted, and the maximum errors are
+        over the points with nonzero weight.
+        """
+        if xdata is None:
+            xdata, ydata, weights = self.xdata, self.ydata, self.weights
+        npt = ydata.size
+        step = chunksize or self.chunksize or npt
+        sqsums, maxima = np.zeros(3), np.zeros(2)
+        for start in range(0, npt, step):
+            rows = slice(start, start + step)
+            ydata_rows = np.asarray(ydata[rows])
+            yhat = self._predict_log(np.asarray(xdata[rows]))
+            yerror = yhat - ydata_rows
+            what = np.exp(yhat)
+            wdata = np.exp(ydata_rows)
+            werror = what - wdata
+            errors = [np.square(yerror), np.square(werror), np.square(werror/wdata)]
+            if weights is None:
+                sqsums += [np.sum(error) for error in errors]
+            else:
+                weights_rows = np.asarray(weights[rows])
+                sqsums += [np.dot(weights_rows, error) for error in errors]
+                werror = werror[weights_rows > 0]
+                wdata = wdata[weights_rows > 0]
+            if werror.size:
+                maxima = np.maximum(maxima, [max(abs(werror)), max(abs(werror/wdata))])
+        rms = np.sqrt(sqsums/(npt if weights is None else np.sum(weights)))
+        return {
+            "rms_log": rms[0],
+            "rms_abs": rms[1],
+            "rms_rel": rms[2],
+            "max_abs": maxima[0],
+            "max_rel": maxima[1],
+        }
+
+    def refit(self, xdata, ydata, **kwargs):
+        """Fits new data, warm-started from this fit's parameters
+
+        Arguments
+        ---------
+        xdata, ydata:
+            New data, as for __init__
+
+        **kwargs:
+            Overrides for the options of this fit (e.g. verbosity). A
+            "homotopy" fit is refit with "lm" unless solver is given, since
+            the softness continuation would discard the warm start
+
+        Returns
+        -------
+            New Fit object of the same type and number of terms
+
+        """
+        options = {"alpha0": self.parameters["alpha0"],
+                   "solver_options": self.solver_options,
+                   "jacobian_type": self.jacobian_type,
+                   "solver": "lm" if self.solver == "homotopy" else self.solver,
+                   "chunksize": self.chunksize,
+                   "workers": self.workers,
+                   "batchsize": self.batchsize}
+        options.update(kwargs)
+        return type(self)(xdata, ydata, self.K, params0=self, **options)
+
+    def split_params(self):
+        """Initial parameters for a (K + 1)-term fit, splitting one term
+
+        The term whose partition (the points where its affine function is
+        largest) holds the largest share of the squared residual is split in
+        two: its points are divided at the median of their principal
+        direction, and each half gets its own local least squares fit.
+
+        Returns
+        -------
+        1D numpy array
+            params0 for a fit of the same type with K + 1 terms
+
+        """
+        K, d = self.K, self.d
+        nba = K*(d + 1)
+        ba = self.params[:nba].reshape(d + 1, K, order="F")
+        X = np.hstack((np.ones((self.ydata.size, 1)), self.xdata))
+        partition = np.dot(X, ba).argmax(1)
+        r = self._evaluate_y(self.xdata, self.params)[0] - self.ydata
+        sqerrors = r**2 if self.weights is None else self.weights*r**2
+        k = np.bincount(partition, weights=sqerrors, minlength=K).argmax()
+        inds = (partition == k).nonzero()[0]
+        newba = np.hstack((ba, ba[:, [k]]))
+        if inds.size >= 2*(d + 1):
+            xk = self.xdata[inds] - self.xdata[inds].mean(0)
+            proj = np.dot(xk, np.linalg.svd(xk, full_matrices=False)[2][0])
+            median = np.median(proj)
+            for col, half in ((k, inds[proj <= median]), (K, inds[proj > median])):
+                if np.linalg.matrix_rank(X[half]) == d + 1:
+                    newba[:, col] = np.linalg.lstsq(X[half], self.ydata[half],
+                                                    rcond=-1)[0]
+        return np.hstack((newba.flatten("F"),
+                          self._split_softness(self.params[nba:], k)))
+
+    def predict_log(self, x, return_w=False, chunksize=PREDICT_CHUNKSIZE):
+        """Evaluates the fit in log space, without forming the Jacobian
+
+        Arguments
+        ---------
+        x: 1D or 2D numpy array [nDim, nPoints]
+            Log transformed independent variable data, laid out as the xdata
+            passed to the fit
+
+        return_w: bool
+            If True, return w = exp(y) rather than y
+
+        chunksize: int
+            Maximum number of points evaluated at once
+
+        Returns
+        -------
+        1D numpy array [nPoints]
+            y (or w, if return_w) at each point
+
+        """
+        x = np.asarray(x, dtype=float)
+        x = x.reshape(x.size, 1) if x.ndim == 1 else x.T
+        if x.shape[1] != self.d:
+            raise ValueError(f"x should have {self.d} rows, one per dimension")
+        y = self._predict_log(x, chunksize)
+        return np.exp(y, out=y) if return_w else y
+
+    def predict(self, u, chunksize=PREDICT_CHUNKSIZE):
+        """Evaluates the fit at u, returning w
+
+        Arguments
+        ---------
+        u: 1D or 2D numpy array [nDim, nPoints]
+            Independent variable data, laid out as for predict_log
+
+        chunksize: int
+            Maximum number of points evaluated at once
+
+        Returns
+        -------
+        w: 1D numpy array [nPoints]
+
+        """
+        return self.predict_log(np.log(u), return_w=True, chunksize=chunksize)
+
+    def _predict_log(self, x, chunksize=PREDICT_CHUNKSIZE):
+        """y at x [nPoints x nDim], evaluated chunksize points at a time"""
+        if x.shape[0] <= chunksize:
+            return self._evaluate_y(x, self.params)[0]
+        return self.evaluate_chunked(x, self.params, chunksize=chunksize)
+
+    @classmethod
+    def evaluate_chunked(cls, x, params, jacobian=False, out=None, jac_out=None,
+                         max_bytes=EVALUATE_MAX_BYTES, chunksize=None,
+                         max_workers=1):
+        """
+        Evaluates the fit at x in blocks of points, so that memory use is
+        bounded regardless of the number of points
+
+        Arguments
+        ---------
+        x: 2D numpy array [nPoints x nDim]
+            Independent variable data (as for evaluate); may be a memmap
+
+        params: 1D numpy array
+            Fit parameters (as for evaluate)
+
+        jacobian: bool
+            If True, also compute dydp
+
+        out: None or 1D array [nPoints]
+            Array (e.g. a memmap) that y is written into
+
+        jac_out: None or 2D array [nPoints x nParams]
+            Array (e.g. a memmap) that dydp is written into, if jacobian
+
+        max_bytes: int
+            Approximate memory budget for the temporaries of all blocks
+            being evaluated at once
+
+        chunksize: None or int
+            Number of points per block; overrides max_bytes
+
+        max_workers: int
+            Number of threads evaluating blocks concurrently (NumPy releases
+            the GIL in the heavy operations)
+
+        Returns
+        -------
+        y: 1D array [nPoints]
+            out, if given
+
+        dydp: 2D array [nPoints x nParams]
+            Only if jacobian; jac_out, if given
+
+        """
+        npt = x.shape[0]
+        nparam = params.size
+        if out is None:
+            out = np.empty(npt)
+        if jacobian and jac_out is None:
+            jac_out = np.empty((npt, nparam))
+        if chunksize is None:
+            rowbytes = 8*nparam*(EVALUATE_TEMPORARIES + 2*jacobian)
+            chunksize = max(1, max_bytes//(max_workers*rowbytes))
+
+        def evaluate_rows(start):
+            rows = slice(start, start + chunksize)
+            out[rows], cache = cls._evaluate_y(np.asarray(x[rows]), params)
+            if jacobian:
+                jac_out[rows] = (np.nan if cache is None else
+                                 cls._evaluate_jacobian(cache))
+
+        starts = range(0, npt, chunksize)
+        if max_workers == 1 or len(starts) == 1:
+            for start in starts:
+                evaluate_rows(start)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(evaluate_rows, starts))
+        if jacobian:
+            return out, jac_out
+        return out
+
     def residual(self, params):
-        """Calculate residual"""
+        """Calculate residual (scaled by sqrt(weights), if any)"""
         [yhat, drdp] = self.evaluate(self.xdata, params)
         r = yhat - self.ydata
+        if self.weights is not None:
+            sqrtw = np.sqrt(self.weights)
+            r, drdp = r*sqrtw, drdp*sqrtw[:, np.newaxis]
         return r, drdp
 
+    def _residual(self, params):
+        """Calculate residual only, caching intermediates for _jacobian"""
+        yhat, cache = self._evaluate_y(self.xdata, params, self._workspace)
+        self._cache = (params, cache)
+        return yhat - self.ydata
+
+    def _jacobian(self, params):
+        """Calculate drdp, reusing intermediates from the last _residual"""
+        if self._cache is None or not np.array_equal(self._cache[0], params):
+            self._residual(params)
+        return self._evaluate_jacobian(self._cache[1], self.jacobian_type,
+                                       self._workspace)
+
+    def _split_softness(self, softness, k):  # pylint: disable=unused-argument
+        """Softness parameters after term k is split in two"""
+        return softness
+
+    def _solve(self, initparams):
+        """Runs the solver from initparams, and sets solve_report
+
+        solve_report is the report of the last solver stage (see
+        levenberg_marquardt's full_output), with its "rmstraj" and wall
+        "time", plus the "solver", the total "time", and the reports of any
+        earlier "stages" (batches, or fixed-softness problems). If the
+        callback stopped a stage, no later stage is run, and the report's
+        termination is "callback".
+        """
+        t = time()
+        self._stages = []
+        params = self._solve_stages(initparams)
+        report = dict(self._stages[-1])
+        report.update(solver=self.solver, stages=self._stages[:-1],
+                      time=time() - t)
+        self.solve_report = report
+        return params
+
+    def _solve_stages(self, initparams):
+        """Runs the solver from initparams on the residual stages"""
+        if self.batchsize is not None:
+            initparams = self._solve_batches(initparams)
+        elif self.solver == "homotopy":
+            initparams = self._solve_homotopy(initparams)
+        if self._cancelled():
+            return initparams
+        if self.solver == "partition":
+            return self._solve_stage(max_affine_partition, self.xdata, self.ydata,
+                                     initparams, self.weights, **self.solver_options)
+        if self.workers is not None:
+            chunksize = self.chunksize or max(1, CHUNK_ELEMENTS//initparams.size)
+            with ParallelLeastSquares(self._evaluate_y, self._evaluate_jacobian,
+                                      self.xdata, self.ydata, chunksize,
+                                      self.workers, self.weights) as problem:
+                return self._solve_stage(levenberg_marquardt, problem.residual,
+                                         initparams, jacfun=problem.jacobian,
+                                         npoints=problem.npt,
+                                         **self.solver_options)
+        residfun, jacfun, weights = self._residual, self._jacobian, self.weights
+        options = self.solver_options
+        if self.chunksize is not None:
+            problem = StreamedLeastSquares(self._evaluate_y, self._evaluate_jacobian,
+                                           self.xdata, self.ydata, self.chunksize,
+                                           self.weights)
+            residfun, jacfun, weights = problem.residual, problem.jacobian, None
+            # the compressed residual has the norm of all of the points
+            options = dict(options, npoints=problem.npt)
+        backend = BACKENDS.get(self.solver, levenberg_marquardt)
+        return self._solve_stage(backend, residfun, initparams, jacfun=jacfun,
+                                 weights=weights, **options)
+
+    def _solve_stage(self, solve, *args, **options):
+        """Runs one solver stage with the fit's callback and records its
+        report; returns the stage's parameters"""
+        t = time()
+        params, rmstraj, info = solve(*args, full_output=True,
+                                      callback=self._callback, **options)
+        info.update(rmstraj=rmstraj, time=time() - t)
+        self._stages.append(info)
+        return params
+
+    def _cancelled(self):
+        """Whether the callback stopped the last solver stage"""
+        return bool(self._stages) and self._stages[-1]["termination"] == "callback"
+
+    def _solve_batches(self, initparams):
+        """Approximate solution from fits to growing random subsets of the data
+
+        Far from the optimum a subset gives about as good a step as the full
+        data, at a fraction of the cost. The batches are nested (leading
+        points of one random permutation), so each stage starts close to its
+        own optimum; the full-data solve then starts from the last stage.
+        """
+        npt = self.ydata.size
+        order = np.random.RandomState(self._batch_seed).permutation(npt)
+        options = dict(self.solver_options)
+        if self.solver != "partition":
+            options["tolrms"] = max(options.get("tolrms", 0), BATCH_TOLRMS)
+        options["maxiter"] = min(options.get("maxiter", BATCH_MAXITER), BATCH_MAXITER)
+        params = initparams
+        batch = max(self.batchsize, 2*initparams.size)
+        while batch < npt and not self._cancelled():
+            rows = np.sort(order[:batch])
+            f = type(self)(np.asarray(self.xdata[rows]).T,
+                           np.asarray(self.ydata[rows]), self.K,
+                           alpha0=self.parameters["alpha0"],
+                           solver_options=options,
+                           jacobian_type=self.jacobian_type,
+                           solver=self.solver, params0=params,
+                           weights=(None if self.weights is None else
+                                    np.asarray(self.weights[rows])),
+                           callback=self._callback)
+            params = f.params
+            self._stages.append(f.solve_report)
+            batch *= BATCH_GROWTH
+        return params
+
     def plot(self):
         """Plots fit alongside original data for a 1D fit"""
         f, ax = plt.subplots()
@@ -93,7 +604,7 @@ class _Fit:
         ax.plot(udata, wdata, "+r")
 
         xx = np.linspace(min(self.xdata), max(self.xdata), 10)
-        yy, _ = self.evaluate(xx, self.params)
+        yy = self._predict_log(xx)
         uu = np.exp(xx)
         ww = np.exp(yy)
         ax.plot(uu, ww)
@@ -121,7 +632,7 @@ class _Fit:
         x2 = np.linspace(min(self.xdata[:, 1]), max(self.xdata[:, 1]), 10)
         xx1, xx2 = np.meshgrid(x1, x2)
         xx = np.vstack((xx1.flatten(), xx2.flatten()))
-        yy, _ = self.evaluate(xx.T, self.params)
+        yy = self._predict_log(xx.T)
         uu1, uu2 = np.exp(xx1), np.exp(xx2)
         ww = np.exp(yy)
         ax.plot_surface(uu1, uu2, ww.reshape(uu1.shape), cmap=cm.coolwarm,
@@ -149,7 +660,7 @@ class _Fit:
         for x2slice in x2slices:
             x2 = x2slice*np.ones(x1.shape)
             xx = np.vstack((x1, x2))
-            yy, _ = self.evaluate(xx.T, self.params)
+            yy = self._predict_log(xx.T)
             u1, u2slice = np.exp(x1), np.exp(x2slice)
             ww = np.exp(yy)
             ax.plot(u1, ww, c=cm.viridis(norm(u2slice)),
@@ -192,10 +703,16 @@ class _Fit:
 
 class MaxAffine(_Fit):
     """Max Affine fit class"""
+    jacobian_types = ("dense", "sparse")
+    solvers = _Fit.solvers + ("partition",)
 
-    def get_parameters(self, ba, K, d):
+    def _default_params(self, ba, K):  # pylint: disable=unused-argument
+        """Initial fit parameters from initial max affine parameters"""
+        return ba
+
+    def get_parameters(self, params0, K, d):
         """Get fit parameters"""
-        params, _ = levenberg_marquardt(self.residual, ba)
+        params = self._solve(params0)
 
         # A: exponent parameters, B: coefficient parameters
         A = params[[i for i in range(K*(d + 1)) if i % (d + 1) != 0]]
@@ -231,21 +748,50 @@ class MaxAffine(_Fit):
         dydba: 2D array [nPoints x (nDim + 1)*K]
             dydba
         """
+        y, cache = MaxAffine._evaluate_y(x, params)
+        return y, MaxAffine._evaluate_jacobian(cache)
+
+    @staticmethod
+    def _evaluate_y(x, params, workspace=None):
+        """Max affine output, and the intermediates used by the Jacobian
+
+        workspace is a Workspace for x, or None
+        """
         ba = params
         npt, dimx = x.shape
         K = ba.size // (dimx + 1)
         ba = np.reshape(ba, (dimx + 1, K), order="F")  # 'F' gives Fortran indexing
-        X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
-        y, partition = np.dot(X, ba).max(1), np.dot(X, ba).argmax(1)
+        if workspace is None:
+            X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
+            z = np.dot(X, ba)
+        else:
+            X, z = workspace.X, workspace.affine(ba)
+        partition = z.argmax(1)
+        y = z[np.arange(npt), partition]
+        return y, (X, partition, K)
 
-        dydba = np.zeros((npt, (dimx + 1)*K))
-        for k in range(K):
-            inds = np.equal(partition, k)
-            indadd = (dimx + 1)*k
-            ixgrid = np.ix_(inds.nonzero()[0], indadd + np.arange(dimx + 1))
-            dydba[ixgrid] = X[inds, :]
+    @staticmethod
+    def _evaluate_jacobian(cache, jacobian_type="dense", workspace=None):
+        """dydba from the intermediates of _evaluate_y
 
-        return y, dydba
+        Each row has only nDim + 1 nonzeros (the block of its active affine
+        function), so jacobian_type "sparse" returns a CSR matrix. A dense
+        dydba is written into the workspace's buffer, if one is given.
+        """
+        X, partition, K = cache
+        npt, ncol = X.shape
+        cols = partition[:, np.newaxis]*ncol + np.arange(ncol)
+        if jacobian_type == "sparse":
+            indptr = np.arange(0, npt*ncol + 1, ncol)
+            return csr_matrix((X.ravel(), cols.ravel(), indptr),
+                              shape=(npt, ncol*K))
+        if workspace is None:
+            dydba = np.zeros((npt, ncol*K))
+        else:
+            dydba = workspace.buffer("dydp", (npt, ncol*K))
+            dydba.fill(0)
+        dydba[np.arange(npt)[:, np.newaxis], cols] = X
+        return dydba
 
     def __repr__(self):
         """String representation of fit"""
@@ -262,11 +808,16 @@ class MaxAffine(_Fit):
 
 class SoftmaxAffine(_Fit):
     """Softmax Affine fit class"""
+    jacobian_types = ("dense", "structured")
+    solvers = _Fit.solvers + ("homotopy",)
 
-    def get_parameters(self, ba, K, d):
+    def _default_params(self, ba, K):  # pylint: disable=unused-argument
+        """Initial fit parameters from initial max affine parameters"""
+        return np.hstack((ba, self.parameters["alpha0"]))
+
+    def get_parameters(self, params0, K, d):
         """Get fit parameters"""
-        alpha0 = self.parameters["alpha0"]
-        params, _ = levenberg_marquardt(self.residual, np.hstack((ba, alpha0)))
+        params = self._solve(params0)
 
         # A: exponent parameters, B: coefficient parameters
         A = params[[i for i in range(K*(d + 1)) if i % (d + 1) != 0]]
@@ -280,6 +831,49 @@ class SoftmaxAffine(_Fit):
                 self.parameters[f"e{k}{i}"] = alpha*A[d*k + i]
         return A, B, alpha, params
 
+    def _solve_homotopy(self, initparams):
+        """Starting point for the joint solve, by softness continuation
+
+        The affine parameters are solved for a geometric sequence of fixed
+        softnesses, from HOMOTOPY_START times the initial softness (nearly
+        max affine, where the problem is well conditioned) up to the initial
+        softness, each stage warm-started from the previous one. The
+        sequence stops once the error grows, which means it has passed the
+        best softness; the best stage is returned. Each stage's report
+        includes its "softness".
+        """
+        options = dict(self.solver_options)
+        options["tolrms"] = max(options.get("tolrms", 0), HOMOTOPY_TOLRMS)
+        options["maxiter"] = min(options.get("maxiter", HOMOTOPY_MAXITER),
+                                 HOMOTOPY_MAXITER)
+        ba, softness0 = initparams[:-1], initparams[-1]
+        nstage = int(np.ceil(np.log(1/HOMOTOPY_START)/np.log(HOMOTOPY_GROWTH)))
+        best = (np.inf, initparams)
+        for softness in softness0*HOMOTOPY_GROWTH**-np.arange(nstage, -1, -1.):
+            residfun, jacfun = self._fixed_softness(softness)
+            ba = self._solve_stage(levenberg_marquardt, residfun, ba,
+                                   jacfun=jacfun, weights=self.weights, **options)
+            self._stages[-1]["softness"] = softness
+            if self._cancelled():
+                return np.hstack((ba, softness))
+            rms = self._stages[-1]["rmstraj"].min()  # the last trial may be rejected
+            if rms >= best[0]:
+                break
+            best = (rms, np.hstack((ba, softness)))
+        return best[1]
+
+    def _fixed_softness(self, softness):
+        """Residual and Jacobian functions of the affine parameters alone"""
+        def residfun(ba):
+            return self._residual(np.hstack((ba, softness)))
+
+        def jacfun(ba):
+            J = self._jacobian(np.hstack((ba, softness)))
+            if isinstance(J, KhatriRaoJacobian):
+                return KhatriRaoJacobian(J.dydz, J.X, J.E[:, :0])
+            return J[:, :-1]
+        return residfun, jacfun
+
     @staticmethod
     def evaluate(x, params):
         """
@@ -304,26 +898,45 @@ class SoftmaxAffine(_Fit):
             Jacobian matrix
         """
 
+        y, cache = SoftmaxAffine._evaluate_y(x, params)
+        if cache is None:
+            return y, np.nan
+        return y, SoftmaxAffine._evaluate_jacobian(cache)
+
+    @staticmethod
+    def _evaluate_y(x, params, workspace=None):
+        """SMA output, and the intermediates used by the Jacobian
+
+        workspace is a Workspace for x, or None
+        """
         npt, dimx = x.shape
         ba = params[0:-1]
         softness = params[-1]
         alpha = 1/softness
         if alpha <= 0:
-            return np.inf*np.ones((npt, 1)), np.nan
+            return np.inf*np.ones(npt), None
         K = np.size(ba) // (dimx + 1)
         ba = ba.reshape(dimx + 1, K, order="F")
-        X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
-        z = np.dot(X, ba)  # compute affine functions
-        y, dydz, dydsoftness = lse_scaled(z, alpha)
+        if workspace is None:
+            X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
+            z = np.dot(X, ba)  # compute affine functions
+        else:
+            X, z = workspace.X, workspace.affine(ba)
+        y, dydz, dydsoftness = lse_scaled(z, alpha, overwrite_x=True)
+        return y, (X, dydz, dydsoftness, alpha)
 
+    @staticmethod
+    def _evaluate_jacobian(cache, jacobian_type="dense", workspace=None):
+        """dydp from the intermediates of _evaluate_y; a dense dydp is
+        written into the workspace's buffer, if one is given"""
+        X, dydz, dydsoftness, alpha = cache
         dydsoftness = -dydsoftness*(alpha**2)
-        nrow, ncol = dydz.shape
-        repmat = np.tile(dydz, (dimx + 1, 1)).reshape(nrow, ncol*(dimx + 1), order="F")
-        dydba = repmat*np.tile(X, (1, K))
-        dydsoftness.shape = (dydsoftness.size, 1)
-        dydp = np.hstack((dydba, dydsoftness))
-
-        return y, dydp
+        dydp = KhatriRaoJacobian(dydz, X, dydsoftness.reshape(dydsoftness.size, 1))
+        if jacobian_type == "structured":
+            return dydp
+        if workspace is None:
+            return dydp.toarray()
+        return dydp.toarray(out=workspace.buffer("dydp", dydp.shape))
 
     def __repr__(self):
         """String representation of fit"""
@@ -343,11 +956,21 @@ class SoftmaxAffine(_Fit):
 
 class ImplicitSoftmaxAffine(_Fit):
     """Implicit Softmax Affine fit class"""
+    jacobian_types = ("dense", "structured")
+
+    def _default_params(self, ba, K):
+        """Initial fit parameters from initial max affine parameters"""
+        return np.hstack((ba, self.parameters["alpha0"]*np.ones(K)))
+
+    def _split_softness(self, softness, k):
+        """Softness parameters after term k is split in two"""
+        # cap at alpha0, so terms that turned max-affine can soften again
+        softness = np.minimum(softness, self.parameters["alpha0"])
+        return np.hstack((softness, softness[k]))
 
-    def get_parameters(self, ba, K, d):
+    def get_parameters(self, params0, K, d):
         """Get fit parameters"""
-        alpha0 = self.parameters["alpha0"]
-        params, _ = levenberg_marquardt(self.residual, np.hstack((ba, alpha0*np.ones(K))))
+        params = self._solve(params0)
 
         # A: exponent parameters, B: coefficient parameters
         A = params[[i for i in range(K*(d + 1)) if i % (d + 1) != 0]]
@@ -387,23 +1010,58 @@ class ImplicitSoftmaxAffine(_Fit):
 
         """
 
+        y, cache = ImplicitSoftmaxAffine._evaluate_y(x, params)
+        if cache is None:
+            return y, np.nan
+        return y, ImplicitSoftmaxAffine._evaluate_jacobian(cache)
+
+    @staticmethod
+    def _evaluate_y(x, params, workspace=None):
+        """ISMA output, and the intermediates used by the Jacobian
+
+        If a Workspace for x is given, lse_implicit is started from the
+        solution at the last accepted point (or, before the first one, from
+        the softmax affine solution with the mean sharpness), and the new
+        solution is kept as the workspace's lse_trial.
+        """
         npt, dimx = x.shape
         K = params.size // (dimx + 2)
         ba = params[0:-K]
         alpha = params[-K:]
         if any(alpha <= 0):
-            return np.inf*np.ones((npt, 1)), np.nan
+            return np.inf*np.ones(npt), None
         ba = ba.reshape(dimx + 1, K, order="F")  # reshape ba to matrix
-        X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
-        z = np.dot(X, ba)  # compute affine functions
-        y, dydz, dydalpha = lse_implicit(z, alpha)
+        if workspace is None:
+            X = np.hstack((np.ones((npt, 1)), x))  # augment data with column of ones
+            z = np.dot(X, ba)  # compute affine functions
+            y, dydz, dydalpha = lse_implicit(z, alpha)
+            return y, (X, dydz, dydalpha)
+        X, z = workspace.X, workspace.affine(ba)
+        zmax = z.max(1)
+        L0 = workspace.lse_guess
+        if L0 is None:
+            L0 = lse_scaled(z, alpha.mean())[0] - zmax
+        y, dydz, dydalpha = lse_implicit(z, alpha, L0=L0)
+        workspace.lse_trial = y - zmax
+        return y, (X, dydz, dydalpha)
 
-        nrow, ncol = dydz.shape
-        repmat = np.tile(dydz, (dimx + 1, 1)).reshape(nrow, ncol*(dimx + 1), order="F")
-        dydba = repmat*np.tile(X, (1, K))
-        dydp = np.hstack((dydba, dydalpha))
+    @staticmethod
+    def _evaluate_jacobian(cache, jacobian_type="dense", workspace=None):
+        """dydp from the intermediates of _evaluate_y; a dense dydp is
+        written into the workspace's buffer, if one is given
 
-        return y, dydp
+        The Jacobian is only evaluated at accepted points, so the
+        workspace's last lse_implicit solution becomes its guess.
+        """
+        X, dydz, dydalpha = cache
+        if workspace is not None:
+            workspace.lse_guess = workspace.lse_trial
+        dydp = KhatriRaoJacobian(dydz, X, dydalpha)
+        if jacobian_type == "structured":
+            return dydp
+        if workspace is None:
+            return dydp.toarray()
+        return dydp.toarray(out=workspace.buffer("dydp", dydp.shape))
 
     def __repr__(self):
         """String representation of fit"""
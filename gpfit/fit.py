@@ -1,9 +1,22 @@
 """Implements the fit function"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from .classes import MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine
+from .maths.coalesce import coalesce
+from .maths.coreset import coreset
 
+FITS = {
+    "ma": MaxAffine,
+    "sma": SoftmaxAffine,
+    "isma": ImplicitSoftmaxAffine,
+}
 
-# pylint: disable=too-many-arguments
-def fit(xdata, ydata, K, fit_type="isma", alpha0=10, verbosity=0, seed=None):
+
+# pylint: disable=too-many-arguments,too-many-locals
+def fit(xdata, ydata, K, fit_type="isma", alpha0=10, verbosity=0, seed=None,
+        solver_options=None, jacobian_type="dense", chain=False,
+        init="random", chunksize=None, workers=None, batchsize=None,
+        weights=None, coalesce_tol=None, solver="lm", callback=None):
     """A convenience function for returning a Fit object.
 
     Default behaviour returns the highest quality of fit (implicit softmax
@@ -32,16 +45,280 @@ def fit(xdata, ydata, K, fit_type="isma", alpha0=10, verbosity=0, seed=None):
     seed: None or int
         Seed for random number generator in initialization function
 
+    solver_options: None or dict
+        Keyword arguments passed on to the selected solver (see solver
+        below), e.g. {"step_solver": "svd"} for "lm" or {"ftol": 1e-10}
+        for the scipy solvers
+
+    jacobian_type: str ("dense", "structured", "sparse")
+        Jacobian representation used while fitting. "structured" is
+        available for "sma" and "isma" fits, "sparse" for "ma" fits
+
+    chain: bool
+        If True, "sma" and "isma" fits are reached by continuation: a max
+        affine fit seeds a softmax affine fit, which (for "isma") seeds the
+        implicit softmax affine fit. Only the max affine fit is initialized
+        from scratch
+
+    init: str ("random", "kmeans++")
+        How the initialization function picks its partition centers
+
+    chunksize: None or int
+        If given, the data (which may then be memmaps or .npy paths) is
+        streamed chunksize points at a time instead of held in memory
+
+    workers: None or int
+        If given, each solver pass over the data is split between this many
+        worker processes holding the data in shared memory
+
+    batchsize: None or int
+        If given, the solver first works on random subsets of the data,
+        starting with batchsize points and growing, and finishes on all of it
+
+    weights: None or 1D numpy array [nPoints,]
+        Nonnegative weight of each data point
+
+    coalesce_tol: None or float
+        If given, points are first merged into weighted representatives
+        (see gpfit.maths.coalesce): 0 merges exact duplicates in x, a
+        positive value merges points within bins of that width
+
+    solver: str ("lm", "scipy-trf", "scipy-lm", "partition", "homotopy")
+        Solver, to which solver_options are passed on: the built-in
+        Levenberg-Marquardt, or scipy.optimize.least_squares with method
+        "trf" or "lm" (see gpfit.maths.backends). "partition" (alternating
+        partition least squares, see gpfit.maths.partition) is available for
+        "ma" fits, and "homotopy" (softness continuation before the joint
+        solve) for "sma" fits
+
+    callback: None or function
+        Called after every solver iteration with a dict describing it (see
+        gpfit.maths.least_squares.levenberg_marquardt); if it returns True,
+        the solve stops early. The fit's solve_report describes the solve
+
     Returns
     -------
         Fit object
 
     """
 
-    fits = {
-        "ma": MaxAffine,
-        "sma": SoftmaxAffine,
-        "isma": ImplicitSoftmaxAffine,
-    }
-    return fits[fit_type](xdata, ydata, K, alpha0=alpha0, verbosity=verbosity,
-                          seed=seed)
+    if coalesce_tol is not None:
+        x = xdata.reshape(xdata.size, 1) if xdata.ndim == 1 else xdata.T
+        x, ydata, weights = coalesce(x, ydata, weights, coalesce_tol)
+        xdata = x.ravel() if xdata.ndim == 1 else x.T
+
+    if not chain or fit_type == "ma":
+        return FITS[fit_type](xdata, ydata, K, alpha0=alpha0,
+                              verbosity=verbosity, seed=seed,
+                              solver_options=solver_options,
+                              jacobian_type=jacobian_type, init=init,
+                              chunksize=chunksize, workers=workers,
+                              batchsize=batchsize, weights=weights,
+                              solver=solver, callback=callback)
+
+    chained = [MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine]
+    chained = chained[:chained.index(FITS[fit_type]) + 1]
+    f = None
+    for fitclass in chained:
+        params0 = None if f is None else _continuation_params(f)
+        f = fitclass(xdata, ydata, K, alpha0=alpha0,
+                     verbosity=verbosity if fitclass is chained[-1] else 0,
+                     seed=seed, solver_options=solver_options,
+                     jacobian_type=(jacobian_type if jacobian_type in
+                                    fitclass.jacobian_types else "dense"),
+                     params0=params0, init=init, chunksize=chunksize,
+                     workers=workers, batchsize=batchsize, weights=weights,
+                     solver=solver if solver in fitclass.solvers else "lm",
+                     callback=callback)
+        if f.solve_report["termination"] == "callback":
+            break
+    return f
+
+
+def _continuation_params(f):
+    """Initial parameters for the fit type after f in the MA -> SMA -> ISMA
+    continuation"""
+    ba = f.params[:f.K*(f.d + 1)]
+    if f.type == "MaxAffine":
+        # softmax affine with softness s is at most s*log(K) above max affine;
+        # pick s so that this offset is comparable to the max affine error
+        softness = f.errors["rms_log"]/np.log(f.K) if f.K > 1 else 0
+        if softness <= 0:
+            softness = f.parameters["alpha0"]
+        return np.hstack((ba, softness))
+    # softmax affine with softness s is implicit softmax affine with all
+    # alphas equal to 1/s
+    return np.hstack((ba, np.ones(f.K)/f.params[-1]))
+
+
+def _fit_with_seed(args):
+    """Runs fit for one start of fit_multistart (picklable for the pool)"""
+    xdata, ydata, K, seed, kwargs = args
+    return fit(xdata, ydata, K, seed=seed, **kwargs)
+
+
+def fit_multistart(xdata, ydata, K, nstarts=8, seed=None, processes=None,
+                   **kwargs):
+    """Fits from several random initializations and returns the best fit
+
+    The starts run concurrently in a process pool. Their seeds are drawn
+    from a random number generator seeded with `seed`, so a given
+    (seed, nstarts) always tries the same initializations.
+
+    Arguments
+    ---------
+    xdata, ydata, K:
+        As for fit
+
+    nstarts: int
+        Number of initializations to try
+
+    seed: None or int
+        Master seed from which the per-start seeds are derived
+
+    processes: None or int
+        Number of worker processes (None uses all cores, 1 runs the starts
+        sequentially in this process)
+
+    **kwargs:
+        Passed on to fit (e.g. fit_type, solver_options)
+
+    Returns
+    -------
+    Fit object
+        The fit with the lowest error
+
+    errors: 1D numpy array [nstarts,]
+        Error of the fit from each start, in start order
+
+    """
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=nstarts)
+    jobs = [(xdata, ydata, K, int(s), kwargs) for s in seeds]
+    if processes == 1:
+        fits = list(map(_fit_with_seed, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            fits = list(pool.map(_fit_with_seed, jobs))
+    errors = np.array([f.error for f in fits])
+    return fits[int(np.argmin(errors))], errors
+
+
+def fit_sweep(xdata, ydata, Kmax, fit_type="isma", tol=0.05, seed=None,
+              **kwargs):
+    """Fits with K = 1, 2, ... Kmax terms and picks the number of terms
+
+    Only the K = 1 fit is initialized from scratch; each larger fit is
+    warm-started from the previous one by splitting the term with the
+    largest share of the squared residual. The sweep stops once adding a
+    term improves the error by less than a fraction tol.
+
+    Arguments
+    ---------
+    xdata, ydata, fit_type:
+        As for fit
+
+    Kmax: int
+        Maximum number of terms
+
+    tol: float
+        Minimum relative error improvement for adding a term
+
+    seed: None or int
+        Seed for random number generator in initialization function
+
+    **kwargs:
+        Passed on to the fit class (e.g. alpha0, solver_options)
+
+    Returns
+    -------
+    Fit object
+        Fit with the selected number of terms
+
+    fits: list of Fit objects
+        All fits of the sweep, in order of K
+
+    """
+    fitclass = FITS[fit_type]
+    fits = [fitclass(xdata, ydata, 1, seed=seed, **kwargs)]
+    for K in range(2, Kmax + 1):
+        prev = fits[-1]
+        if K*(prev.d + 1) > prev.ydata.size:
+            break
+        params0 = prev.split_params()
+        fits.append(fitclass(xdata, ydata, K, params0=params0, **kwargs))
+        if prev.error - fits[-1].error < tol*prev.error:
+            return prev, fits
+    return fits[-1], fits
+
+
+def fit_coreset(xdata, ydata, K, size, fit_type="isma", method="stratified",
+                polish=False, compare=False, seed=None, weights=None, **kwargs):
+    """Fits a small weighted coreset of the data instead of all of it
+
+    The coreset (see gpfit.maths.coreset) has about size points whose
+    weights make its weighted squared error estimate that of the full
+    data. With method "importance", a pilot fit to a stratified coreset
+    scores every point by its squared residual, and a second coreset drawn
+    with those scores refines the pilot fit.
+
+    Arguments
+    ---------
+    xdata, ydata, K, fit_type, seed, weights:
+        As for fit
+
+    size: int
+        Approximate number of points in the coreset
+
+    method: str ("stratified", "importance")
+        How the coreset is sampled
+
+    polish: bool
+        If True, the coreset fit warm-starts a final fit to all of the data
+
+    compare: bool
+        If True, the data is also fit from scratch, and the report includes
+        the errors of that fit and the penalty of the coreset fit
+
+    **kwargs:
+        Passed on to fit (e.g. solver_options, chain)
+
+    Returns
+    -------
+    Fit object
+        The coreset fit (polished, if polish)
+
+    report: dict
+        "npt" and "size" (number of points in the data and the coreset),
+        "errors" (errors of the returned fit on all of the data) and, if
+        compare, "full_errors" (errors of the fit to all of the data) and
+        "penalty" (relative increase of the RMS relative error)
+
+    """
+    if method not in ("stratified", "importance"):
+        raise ValueError(f"unknown coreset method {method!r}")
+    x = xdata.reshape(xdata.size, 1) if xdata.ndim == 1 else xdata.T
+
+    def subset(xc):
+        """xdata layout of coreset points"""
+        return xc.ravel() if xdata.ndim == 1 else xc.T
+
+    xc, yc, wc = coreset(x, ydata, size, seed=seed, weights=weights)
+    f = fit(subset(xc), yc, K, fit_type=fit_type, seed=seed, weights=wc,
+            **kwargs)
+    if method == "importance":
+        scores = np.square(f.predict_log(xdata) - ydata)
+        xc, yc, wc = coreset(x, ydata, size, seed=seed, scores=scores,
+                             weights=weights)
+        f = f.refit(subset(xc), yc, weights=wc)
+    report = {"npt": ydata.size, "size": yc.size}
+    if polish:
+        f = f.refit(xdata, ydata, weights=weights)
+        report["errors"] = f.errors
+    else:
+        report["errors"] = f.errors_on(xdata, ydata, weights)
+    if compare:
+        full = fit(xdata, ydata, K, fit_type=fit_type, seed=seed,
+                   weights=weights, **kwargs)
+        report["full_errors"] = full.errors
+        report["penalty"] = report["errors"]["rms_rel"]/full.errors["rms_rel"] - 1
+    return f, report
@@ -0,0 +1,141 @@
+"Implements the least squares backends the fit classes can solve with"
+from functools import partial
+from time import time
+import numpy as np
+from numpy.linalg import norm
+from scipy.optimize import least_squares
+from scipy.sparse import issparse
+from .least_squares import levenberg_marquardt, _weighted
+
+
+class _Cancelled(Exception):
+    """Raised to stop least_squares when the callback asks to"""
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def scipy_least_squares(residfun, initparams, jacfun=None, weights=None,
+                        method="trf", verbose=False, maxiter=None, tolrms=None,
+                        full_output=False, callback=None, **options):
+    """Solves the problem of levenberg_marquardt with scipy.optimize.least_squares
+
+    Takes and returns the same arguments as levenberg_marquardt, so that it
+    can stand in for it, with two differences: rmstraj holds the RMS error
+    of every residual evaluation (including rejected trial points), and
+    options other than those below are passed on to least_squares (e.g.
+    ftol, gtol, tr_solver). Sparse Jacobians are passed on as they are for
+    "trf", which then uses its sparse (lsmr) trust region solver; structured
+    Jacobians are densified. Parameters are scaled by their Jacobian column
+    norms (x_scale="jac"), as levenberg_marquardt does, unless x_scale is
+    given.
+
+    Arguments
+    ---------
+    residfun, initparams, jacfun, weights, verbose, full_output:
+        As for levenberg_marquardt
+
+    method: str ("trf", "lm")
+        least_squares method: "trf" (trust region reflective) or "lm"
+        (MINPACK's Levenberg-Marquardt, which needs at least as many points
+        as parameters)
+
+    maxiter: None or int
+        Maximum number of residual evaluations (max_nfev)
+
+    tolrms: None or float
+        Tolerance on the relative change in RMS error, converted to ftol
+
+    callback: None or function
+        As for levenberg_marquardt, but called at every point where the
+        Jacobian is evaluated (the initial and accepted points), without
+        "trial_rms", "accepted", "lambda" and "step_norm"
+
+    Returns
+    -------
+    params: np.array (1D)
+        Parameter vector that locally minimizes norm(residfun, 2)
+
+    rmstraj: np.array
+        RMS error of each residual evaluation (first point is initialization)
+
+    info: dict (only if full_output)
+        Report of the solve, with the keys of levenberg_marquardt's. The
+        "termination" reason is least_squares' message (or "callback"),
+        each Jacobian after the first counts as an accepted step and each
+        other residual evaluation as a rejected one, and "solve_time" is all
+        the time not spent evaluating
+
+    """
+    t = time()
+    info = {"termination": None, "iterations": 0, "accepted": 0, "rejected": 0,
+            "accelerated": 0, "residual_evaluations": 0,
+            "jacobian_evaluations": 0, "evaluate_time": 0., "solve_time": 0.}
+    if weights is not None:
+        residfun, jacfun = _weighted(residfun, jacfun, np.sqrt(weights))
+    rmstraj = []
+    last = {"params": None, "J": None}
+    best = {"params": initparams, "rms": np.inf}
+
+    def fun(params):
+        tevaluate = time()
+        info["residual_evaluations"] += 1
+        if jacfun is None:
+            r, last["J"] = residfun(params)
+            last["params"] = params.copy()
+            info["jacobian_evaluations"] += 1
+        else:
+            r = residfun(params)
+        r = np.asarray(r, dtype=float).ravel()
+        rmstraj.append(norm(r)/np.sqrt(r.size))
+        info["evaluate_time"] += time() - tevaluate
+        return r
+
+    def jac(params, *_):
+        tevaluate = time()
+        if jacfun is not None:
+            J = jacfun(params)
+            info["jacobian_evaluations"] += 1
+        elif np.array_equal(last["params"], params):
+            J = last["J"]
+        else:
+            J = residfun(params)[1]
+            info["jacobian_evaluations"] += 1
+        if hasattr(J, "toarray") and (method == "lm" or not issparse(J)):
+            J = J.toarray()
+        info["evaluate_time"] += time() - tevaluate
+        # the Jacobian is only needed at accepted points
+        best["params"], best["rms"] = params.copy(), rmstraj[-1]
+        info["iterations"] += 1
+        if callback is not None and callback({
+                "iteration": info["iterations"] - 1, "params": best["params"],
+                "rms": best["rms"], "time": time() - t,
+                "evaluate_time": info["evaluate_time"],
+                "solve_time": time() - t - info["evaluate_time"]}):
+            raise _Cancelled
+        return J
+
+    if maxiter is not None:
+        options["max_nfev"] = maxiter
+    if tolrms is not None:
+        options["ftol"] = 2*tolrms  # cost is proportional to rms^2
+    options.setdefault("x_scale", "jac")
+    try:
+        result = least_squares(fun, initparams, jac=jac, method=method,
+                               verbose=2 if verbose else 0, **options)
+        params, info["termination"] = result.x, result.message
+    except _Cancelled:
+        params, info["termination"] = best["params"], "callback"
+    info["iterations"] = max(info["iterations"] - 1, 0)
+    info["accepted"] = info["iterations"]
+    info["rejected"] = max(len(rmstraj) - 1 - info["accepted"], 0)
+    info["solve_time"] = time() - t - info["evaluate_time"]
+    if full_output:
+        return params, np.array(rmstraj), info
+    return params, np.array(rmstraj)
+
+
+# Solvers of the residual stages of a fit, by fit solver name
+BACKENDS = {
+    "lm": levenberg_marquardt,
+    "scipy-trf": partial(scipy_least_squares, method="trf"),
+    "scipy-lm": partial(scipy_least_squares, method="lm"),
+}
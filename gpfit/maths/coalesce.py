@@ -0,0 +1,57 @@
+"Implements coalesce, which merges repeated data points into weighted ones"
+import numpy as np
+
+
+def coalesce(x, y, weights=None, tol=0):
+    """Merges points with the same x into one weighted representative
+
+    Each group of points is replaced by one point whose weight is the total
+    weight of the group and whose y is the weighted mean of the group's y.
+    For points with identical x (tol=0) the weighted sum of squared
+    residuals then differs from the original one only by a constant, so a
+    weighted fit to the merged data has the same solution.
+
+    With tol > 0, x is binned on a grid of cells of width tol in every
+    dimension, and each representative sits at the weighted mean x of its
+    cell, which approximates the original problem.
+
+    Arguments
+    ---------
+    x: 2D numpy array [nPoints x nDim]
+        Independent variable data
+
+    y: 1D numpy array [nPoints]
+        Dependent variable data
+
+    weights: None or 1D numpy array [nPoints]
+        Weight of each point (default 1); points of zero weight are dropped
+
+    tol: float
+        Bin width; 0 merges only exact duplicates
+
+    Returns
+    -------
+    x: 2D numpy array [nUnique x nDim]
+
+    y: 1D numpy array [nUnique]
+
+    weights: 1D numpy array [nUnique]
+
+    """
+    if weights is None:
+        weights = np.ones(y.size)
+    else:  # zero-weight points do not affect the fit
+        keep = weights > 0
+        x, y, weights = x[keep], y[keep], weights[keep]
+    keys = x if tol == 0 else np.floor(x/tol)
+    _, first, group = np.unique(keys, axis=0, return_index=True,
+                                return_inverse=True)
+    group = group.ravel()  # numpy 2.0.x returns it with the shape of keys
+    wsum = np.bincount(group, weights=weights)
+    ymean = np.bincount(group, weights=weights*y)/wsum
+    if tol == 0:
+        xmean = x[first]
+    else:
+        xmean = np.column_stack([np.bincount(group, weights=weights*x[:, i])/wsum
+                                 for i in range(x.shape[1])])
+    return xmean, ymean, wsum
@@ -0,0 +1,84 @@
+"Implements coreset, a small weighted sample standing in for a large dataset"
+import numpy as np
+from .coalesce import coalesce
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def coreset(x, y, size, seed=None, scores=None, weights=None):
+    """Weighted sample of about size points whose weighted sum of squared
+    residuals estimates that of the full data, for any fit
+
+    By default the sample is stratified: x is binned on a grid of about
+    size cells, and each occupied cell contributes a number of points
+    proportional to its (weighted) population, at least one, so sparse
+    regions of x stay represented. Each sampled point carries the weight of
+    the points it stands for.
+
+    If scores are given (e.g. squared residuals of a pilot fit), points are
+    instead drawn with probability proportional to an even mix of the
+    scores and the weights (error-guided importance sampling), with
+    weights that keep the estimate unbiased; repeated draws are merged.
+
+    Arguments
+    ---------
+    x: 2D numpy array [nPoints x nDim]
+        Independent variable data
+
+    y: 1D numpy array [nPoints]
+        Dependent variable data
+
+    size: int
+        Approximate number of points in the coreset
+
+    seed: None or int
+        Seed for the random number generator
+
+    scores: None or 1D numpy array [nPoints]
+        Nonnegative importance of each point
+
+    weights: None or 1D numpy array [nPoints]
+        Weight of each point in the full data (default 1)
+
+    Returns
+    -------
+    x: 2D numpy array [nCoreset x nDim]
+
+    y: 1D numpy array [nCoreset]
+
+    weights: 1D numpy array [nCoreset]
+
+    """
+    npt, dimx = x.shape
+    if weights is None:
+        weights = np.ones(npt)
+    if size >= npt:
+        return x, y, weights
+    rng = np.random.RandomState(seed)
+
+    if scores is not None:
+        prob = weights/weights.sum()
+        if scores.sum() > 0:
+            prob = 0.5*prob + 0.5*scores/scores.sum()
+        draws = rng.choice(npt, size=size, p=prob)
+        return coalesce(x[draws], y[draws], weights[draws]/(size*prob[draws]))
+
+    # grid over the bounding box of x; each cell gets at least one point
+    lower, upper = x.min(0), x.max(0)
+    ncell = max(1, int((size/2)**(1/dimx)))  # at most size/2 cells
+    cell = np.minimum(((x - lower)/np.where(upper > lower, upper - lower, 1)
+                       *ncell).astype(int), ncell - 1)
+    _, group = np.unique(cell, axis=0, return_inverse=True)
+    group = group.ravel()
+    population = np.bincount(group, weights=weights)
+    quota = np.maximum(1, np.round(size*population/population.sum())).astype(int)
+
+    # random order within each cell; keep the first quota points of each
+    order = np.lexsort((rng.random_sample(npt), group))
+    starts = np.searchsorted(group[order], np.arange(population.size))
+    rank = np.empty(npt, dtype=int)
+    rank[order] = np.arange(npt) - starts[group[order]]
+    keep = rank < quota[group]
+    # each kept point stands for its share of the cell's weight
+    scale = population/np.bincount(group[keep], weights=weights[keep],
+                                   minlength=population.size)
+    return x[keep], y[keep], weights[keep]*scale[group[keep]]
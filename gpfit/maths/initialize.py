@@ -1,11 +1,14 @@
 "Implements get_initial_parameters"
 import numpy as np
-from numpy import ones, hstack, zeros, tile, argmin
-from numpy.linalg import lstsq, matrix_rank
+from numpy import ones, hstack, zeros, argmin
+from numpy.linalg import lstsq, matrix_rank, svd
 
+# Number of candidate points checked at once when growing a partition
+BLOCKSIZE = 1024
 
-# pylint: disable=too-many-locals
-def get_initial_parameters(x, y, K, seed=None):
+
+# pylint: disable=too-many-locals,too-many-arguments
+def get_initial_parameters(x, y, K, seed=None, init="random", weights=None):
     """Initializes max-affine fit to data (y, x)
 
     Ensures that initialization has at least K+1 points per partition (i.e.
@@ -19,6 +22,15 @@ def get_initial_parameters(x, y, K, seed=None):
         Dependent variable data
     K: int
         Number of terms in fit
+    seed: None or int
+        Seed for the random number generator
+    init: str ("random", "kmeans++")
+        How the K partition centers are chosen: K distinct data points drawn
+        uniformly, or k-means++ seeding (each new center drawn with
+        probability proportional to its squared distance from the nearest
+        chosen center)
+    weights: None or 1D array [nPoints]
+        Weights of the points in the local least squares fits
 
     Returns:
     --------
@@ -35,12 +47,16 @@ def get_initial_parameters(x, y, K, seed=None):
     b = zeros((dimx + 1, K))
 
     rng = np.random.RandomState(seed)
-    randinds = rng.permutation(npt)[0:K]  # Choose K unique indices
+    if init == "random":
+        centers = x[rng.permutation(npt)[0:K]]  # Choose K unique indices
+    elif init == "kmeans++":
+        centers = kmeanspp_centers(x, K, rng)
+    else:
+        raise ValueError(f"Unknown init '{init}'. Options are 'random' and "
+                         "'kmeans++'")
 
     # partition based on distances
-    sqdists = zeros((npt, K))
-    for k in range(K):
-        sqdists[:, k] = ((x - tile(x[randinds[k], :], (npt, 1)))**2).sum(1)
+    sqdists = squared_distances(x, centers)
 
     # index to closest k for each data pt
     mindistind = argmin(sqdists, axis=1)
@@ -56,23 +72,86 @@ def get_initial_parameters(x, y, K, seed=None):
         # before fitting, check rank and increase partition size if necessary
         # (this does create overlaps)
         if matrix_rank(X[inds, :]) < dimx + 1:
-            sortdistind = sqdists[:, k].argsort()
-
-            i = sum(inds)  # number of points in partition
-
-            if i < dimx + 1:
-                # obviously, at least need dimx+1 points. fill these in before
-                # checking any ranks
-                inds[sortdistind[i + 1 : dimx + 1]] = 1  # TODO: check index
-                i = dimx + 1  # TODO: check index
-
-            # now add points until rank condition satisfied
-            while matrix_rank(X[inds, :]) < dimx + 1:
-                i = i + 1
-                inds[sortdistind[i]] = 1
+            grow_partition(X, inds, sqdists[:, k].argsort())
 
         # now create the local fit
-        b[:, k] = lstsq(X[inds.nonzero()], y[inds.nonzero()], rcond=-1)[0][:, 0]
+        Xk, yk = X[inds.nonzero()], y[inds.nonzero()]
+        if weights is not None:
+            sqrtw = np.sqrt(weights[inds.nonzero()])[:, np.newaxis]
+            Xk, yk = sqrtw*Xk, sqrtw*yk
+        b[:, k] = lstsq(Xk, yk, rcond=-1)[0][:, 0]
         # Rank condition specified to default for python upgrades
 
     return b
+
+
+def squared_distances(x, centers):
+    """Squared distances [nPoints x K] from each point to each center
+
+    Uses |x - c|^2 = |x|^2 - 2 x.c + |c|^2, so that no nPoints x nDims array
+    is allocated per center.
+    """
+    sqdists = np.dot(x, -2*centers.T)
+    sqdists += (x**2).sum(1)[:, np.newaxis]
+    sqdists += (centers**2).sum(1)
+    return np.maximum(sqdists, 0, out=sqdists)  # clip round-off below zero
+
+
+def kmeanspp_centers(x, K, rng):
+    """K centers chosen from the rows of x by k-means++ seeding"""
+    npt = x.shape[0]
+    inds = [rng.randint(npt)]
+    mindists = squared_distances(x, x[inds])[:, 0]
+    for _ in range(1, K):
+        total = mindists.sum()
+        if total > 0:
+            ind = min(np.searchsorted(mindists.cumsum(), rng.random_sample()*total,
+                                      side="right"), npt - 1)
+        else:  # all points coincide with chosen centers
+            ind = rng.randint(npt)
+        inds.append(ind)
+        np.minimum(mindists, squared_distances(x, x[[ind]])[:, 0], out=mindists)
+    return x[inds]
+
+
+def grow_partition(X, inds, order, tol=1e-10):
+    """Adds points to a partition until its rows of X have full column rank
+
+    Points are added in the given order (nearest first), stopping at the
+    point that completes the rank. Rather than recomputing the rank after
+    each added point, candidates are projected in blocks onto the
+    orthogonal complement of the partition's current row space: the first
+    candidate with a nonzero remainder raises the rank by one.
+
+    Arguments
+    ---------
+    X: 2D array [nPoints x (nDims + 1)]
+        Augmented independent variable data
+    inds: 1D boolean array [nPoints]
+        Partition membership, updated in place
+    order: 1D int array
+        Order in which points are considered for addition
+    tol: float
+        Relative remainder above which a point is independent of the basis
+    """
+    ncol = X.shape[1]
+    _, s, vt = svd(X[inds], full_matrices=False)
+    basis = vt[s > tol*s.max()] if s.size and s.max() > 0 else vt[:0]
+    order = order[~inds[order]]
+    start = 0
+    while basis.shape[0] < ncol and start < order.size:
+        block = order[start:start + BLOCKSIZE]
+        rows = X[block]
+        remainder = rows - np.dot(np.dot(rows, basis.T), basis)
+        independent = (np.sqrt((remainder**2).sum(1))
+                       > tol*np.sqrt((rows**2).sum(1))).nonzero()[0]
+        if not independent.size:
+            inds[block] = True
+            start += block.size
+            continue
+        i = independent[0]
+        inds[block[:i + 1]] = True
+        newdir = remainder[i]/np.sqrt(np.dot(remainder[i], remainder[i]))
+        basis = np.vstack((basis, newdir))
+        start += i + 1
+    return inds
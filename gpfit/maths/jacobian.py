@@ -0,0 +1,85 @@
+"Implements structured Jacobians for the softmax affine fits"
+import numpy as np
+
+# Maximum number of elements materialized at once when forming J'J
+CHUNK_ELEMENTS = 2**22
+
+
+# pylint: disable=invalid-name
+class KhatriRaoJacobian:
+    """
+    Jacobian of the form [dydz (*) X, E], where (*) is the row-wise
+    Kronecker (Khatri-Rao) product. Column k*(d+1) + j of the first block is
+    dydz[:, k]*X[:, j], matching the parameter ordering
+    [b1, a11, .. a1d, b2, ..., bK, aK1, .. aKd]; E holds the remaining
+    (softness) columns.
+
+    Only dydz, X and E are stored, so products with J never materialize the
+    npt x K(d+1) block (except in chunks of CHUNK_ELEMENTS, in gram).
+
+    Arguments
+    ---------
+    dydz: 2D numpy array [nPoints x K]
+        Derivative of the output with respect to each affine function
+
+    X: 2D numpy array [nPoints x (nDim + 1)]
+        Independent variable data augmented with a column of ones
+
+    E: 2D numpy array [nPoints x nExtra]
+        Derivative of the output with respect to the softness parameters
+    """
+
+    def __init__(self, dydz, X, E):
+        self.dydz, self.X, self.E = dydz, X, E
+        npt, K = dydz.shape
+        self.nba = K*X.shape[1]
+        self.shape = (npt, self.nba + E.shape[1])
+
+    def _block(self, rows=slice(None)):
+        """Materializes rows of the Khatri-Rao block"""
+        dydz, X = self.dydz[rows], self.X[rows]
+        return (dydz[:, :, np.newaxis]*X[:, np.newaxis, :]).reshape(
+            dydz.shape[0], self.nba)
+
+    def toarray(self, out=None):
+        """Dense Jacobian [nPoints x nParams], written into out if given"""
+        if out is None:
+            return np.hstack((self._block(), self.E))
+        npt, K = self.dydz.shape
+        np.multiply(self.dydz[:, :, np.newaxis], self.X[:, np.newaxis, :],
+                    out=out[:, :self.nba].reshape(npt, K, self.X.shape[1]))
+        out[:, self.nba:] = self.E
+        return out
+
+    def matvec(self, v):
+        """J v"""
+        v = np.asarray(v).ravel()
+        V = v[:self.nba].reshape(self.dydz.shape[1], self.X.shape[1])
+        return (np.dot(self.X, V.T)*self.dydz).sum(1) + np.dot(self.E, v[self.nba:])
+
+    def rmatvec(self, r):
+        """J'r"""
+        r = np.asarray(r).ravel()
+        top = np.dot((self.dydz*r[:, np.newaxis]).T, self.X).ravel()
+        return np.hstack((top, np.dot(self.E.T, r)))
+
+    def scale_rows(self, s):
+        """diag(s) J, as a KhatriRaoJacobian"""
+        s = np.asarray(s).reshape(-1, 1)
+        return KhatriRaoJacobian(self.dydz*s, self.X, self.E*s)
+
+    def column_sqnorms(self):
+        """diag(J'J)"""
+        top = np.dot((self.dydz**2).T, self.X**2).ravel()
+        return np.hstack((top, (self.E**2).sum(0)))
+
+    def gram(self):
+        """J'J, accumulated over chunks of rows"""
+        npt, nparam = self.shape
+        chunk = max(1, CHUNK_ELEMENTS//nparam)
+        JJ = np.zeros((nparam, nparam))
+        for start in range(0, npt, chunk):
+            rows = slice(start, start + chunk)
+            Jrows = np.hstack((self._block(rows), self.E[rows]))
+            JJ += np.dot(Jrows.T, Jrows)
+        return JJ
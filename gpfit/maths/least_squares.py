@@ -3,7 +3,15 @@ from time import time
 from sys import float_info
 import numpy as np
 from numpy.linalg import norm
-from scipy.sparse import spdiags, issparse
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+from scipy.sparse import spdiags, issparse, diags, identity, csr_matrix
+from scipy.sparse.linalg import splu, lsqr
+
+# Geodesic acceleration: finite difference step (relative to the velocity)
+# for the second directional derivative, and largest ratio 2|a|/|v| of
+# acceleration to velocity for which the acceleration is used
+GEODESIC_H = 0.1
+GEODESIC_ALPHA = 0.75
 
 
 # pylint: disable=too-many-locals,too-many-arguments,too-many-branches,too-many-statements,no-else-break
@@ -16,6 +24,15 @@ def levenberg_marquardt(
     maxtime=np.inf,
     tolgrad=np.sqrt(float_info.epsilon),
     tolrms=1e-7,
+    step_solver=None,
+    jacfun=None,
+    weights=None,
+    damping="classic",
+    scaling="marquardt",
+    geodesic=False,
+    full_output=False,
+    callback=None,
+    npoints=None,
 ):
     """
     Levenberg-Marquardt alogrithm
@@ -29,6 +46,11 @@ def levenberg_marquardt(
         Examples:
             if residfun is (ydata - y(params)), drdp = - dydp
             if residfun is (y(params) - ydata), drdp = dydp
+        If jacfun is given, residfun returns only r.
+        drdp may be a dense array, a scipy sparse matrix or a structured
+        Jacobian providing
+        gram(), rmatvec(r), column_sqnorms(), scale_rows(s) and toarray() (see
+        gpfit.maths.jacobian.KhatriRaoJacobian)
     initparams: np.array (1D)
         Initial fit parameter guesses
     verbose: bool
@@ -43,6 +65,60 @@ def levenberg_marquardt(
         First-order optimality tolerance
     tolrms: float
         Tolerance on change in rms error per iteration
+    step_solver: None or str ("lstsq", "svd", "cholesky", "sparse")
+        Method used to compute the damped step. Defaults to "lstsq" for dense
+        Jacobians, "cholesky" for structured ones and "sparse" for sparse
+        ones. "lstsq" solves the full
+        augmented least squares system every iteration; "svd" factors the
+        scaled Jacobian once per accepted point and reuses the factorization
+        for every lambda tried from that point; "cholesky" forms the
+        (nparam x nparam) normal equations once per accepted point and
+        solves them by Cholesky factorization, falling back to "lstsq" if
+        the factorization fails; "sparse" keeps J'J sparse and factors it
+        with a sparse LU, falling back to lsqr on the sparse system.
+        "lstsq", "svd" and "cholesky" densify structured and sparse
+        Jacobians
+    jacfun: None or function
+        Mapping from parameters to the Jacobian drdp. If given, it is only
+        called at accepted points, right after residfun was evaluated at the
+        same parameters, so rejected trial points never build a Jacobian
+    weights: None or np.array (1D)
+        Nonnegative weight of each residual. If given, sum(weights*r**2) is
+        minimized: r and drdp are scaled by sqrt(weights) as they are
+        computed
+    damping: str ("classic", "nielsen")
+        How lambda is updated. "classic" multiplies it by 10 after a
+        rejected step and divides it by 10 after two consecutive accepted
+        steps; "nielsen" scales it by the gain ratio of actual to predicted
+        reduction of each accepted step, and increases it by growing
+        factors (2, 4, 8, ...) after consecutive rejected steps
+    scaling: str ("marquardt", "levenberg")
+        Damping matrix: "marquardt" damps each parameter in proportion to
+        its column norm in the Jacobian (diag(J'J)), "levenberg" damps all
+        parameters equally (the identity)
+    geodesic: bool
+        If True, each step is corrected by geodesic acceleration: the
+        second directional derivative of the residual along the step is
+        estimated from one extra residual evaluation, and the resulting
+        second-order correction is added unless it is large compared with
+        the step (see GEODESIC_ALPHA) or the residual is not finite at the
+        extra point. The residual must be the full one:
+        the compressed residuals of gpfit.maths.streaming only keep their
+        norm at trial points, so the estimate would be meaningless
+    full_output: bool
+        If True, also return a report of the solve
+    callback: None or function
+        Called after every iteration with a dict of its "iteration" number,
+        the current (accepted) "params" and their "rms", the "trial_rms",
+        whether the trial step was "accepted", the "lambda" it was computed
+        with and its norm ("step_norm"), and the elapsed "time",
+        "evaluate_time" and "solve_time" (seconds). If it returns True, the
+        solve stops (termination "callback")
+    npoints: None or int
+        Number of points the RMS error is averaged over; defaults to the
+        number of residuals. A compressed residual (see
+        gpfit.maths.streaming) has the norm of a larger one, whose number
+        of points should be given here
 
     Returns
     -------
@@ -50,9 +126,23 @@ def levenberg_marquardt(
         Parameter vector that locally minimizes norm(residfun, 2)
     rmstraj: np.array
         History of RMS errors after each step (first point is initialization)
+    info: dict (only if full_output)
+        Report of the solve: the "termination" reason ("maxiter", "maxtime",
+        "tolrms", "tolgrad" or "callback"), the numbers of "iterations", of
+        "accepted" and "rejected" steps, of steps that used geodesic
+        acceleration ("accelerated"), and of "residual_evaluations" and
+        "jacobian_evaluations", and the time (seconds) spent evaluating them
+        ("evaluate_time") and computing steps ("solve_time")
     """
 
     t = time()
+    info = {"termination": None, "iterations": 0, "accepted": 0, "rejected": 0,
+            "accelerated": 0, "residual_evaluations": 0,
+            "jacobian_evaluations": 0, "evaluate_time": 0., "solve_time": 0.}
+
+    if weights is not None:
+        residfun, jacfun = _weighted(residfun, jacfun, np.sqrt(weights))
+    residfun, jacfun = _instrumented(residfun, jacfun, info)
 
     # Check incoming params
     nparam = initparams.size
@@ -69,7 +159,10 @@ def levenberg_marquardt(
     # Get residual values and jacobian at initial point; extract size info
     params = initparams
     params_updated = True
-    r, J = residfun(params)  # r is a row vector, J is a Jacobian
+    if jacfun is None:
+        r, J = residfun(params)  # r is a row vector, J is a Jacobian
+    else:
+        r, J = residfun(params), jacfun(params)
     npt = r.size
     r.shape = (npt, 1)  # Make r into column vector
 
@@ -78,15 +171,34 @@ def levenberg_marquardt(
         raise ValueError(errstr)
 
     # "Accept" initial point
-    rms = norm(r)/np.sqrt(npt)  # 2-norm
-    maxgrad = norm(np.dot(r.T, J), ord=np.inf)  # Inf-norm
+    if npoints is None:
+        npoints = npt
+    rms = norm(r)/np.sqrt(npoints)  # 2-norm
+    maxgrad = norm(_gradient(J, r), ord=np.inf)  # Inf-norm
     prev_trial_accepted = False
 
     # Initializations
     itr = 0
     Jissparse = issparse(J)
-    diagJJ = sum(J*J, 0).T
-    zeropad = np.zeros((nparam, 1))
+    if scaling not in ("marquardt", "levenberg"):
+        raise ValueError(f"Unknown scaling '{scaling}'. Options are "
+                         "'marquardt' and 'levenberg'")
+    diagJJ = _damping_diagonal(J, scaling)
+    if step_solver is None:
+        if Jissparse:
+            step_solver = "sparse"
+        elif hasattr(J, "gram"):
+            step_solver = "cholesky"
+        else:
+            step_solver = "lstsq"
+    if step_solver not in STEP_SOLVERS:
+        raise ValueError(f"Unknown step solver '{step_solver}'. Options are "
+                         f"{list(STEP_SOLVERS)}")
+    stepper = STEP_SOLVERS[step_solver](npt, nparam)
+    if damping not in DAMPING_STRATEGIES:
+        raise ValueError(f"Unknown damping '{damping}'. Options are "
+                         f"{list(DAMPING_STRATEGIES)}")
+    damper = DAMPING_STRATEGIES[damping]()
     lamb = lambdainit
     rmstraj = [rms]
 
@@ -104,16 +216,19 @@ def levenberg_marquardt(
         if itr == maxiter:
             if verbose:
                 print("Reached maximum number of iterations")
+            info["termination"] = "maxiter"
             break
         elif time() - t > maxtime:
             if verbose:
                 print(f"Reached maxtime ({maxtime} seconds)")
+            info["termination"] = "maxtime"
             break
         elif itr >= 2 and abs(rmstraj[itr] - rmstraj[itr - 2]) < rmstraj[itr]*tolrms:
             # Should really only allow this exit case
             # if trust region constraint is slack
             if verbose:
                 print("RMS changed less than tolrms")
+            info["termination"] = "tolrms"
             break
 
         itr += 1
@@ -127,32 +242,55 @@ def levenberg_marquardt(
         else:
             D = np.diag(np.sqrt(lamb*diagJJ))
 
-        # Update augmented least squares system
+        # Update the step solver for a new point
+        tsolve = time()
         if params_updated:
-            diagJJ = sum(J*J, 0).T
-            augJ = np.vstack((J, D))
+            diagJJ = _damping_diagonal(J, scaling)
             r.shape = (npt, 1)
-            augr = np.vstack((-r, zeropad))
-        else:
-            augJ[npt:, :] = D  # modified from npt+1 ??
+            stepper.update(J, r, diagJJ)
 
         # Compute step for this lambda
-        step = np.linalg.lstsq(augJ, augr, rcond=-1)[0]
-        # Rank condition specified to default for python upgrades
+        step = stepper.solve(lamb, D)
+        info["solve_time"] += time() - tsolve
+        if geodesic:
+            # second directional derivative of r along the step
+            h = GEODESIC_H
+            rh = residfun((params + h*step.T)[0])
+            rh = (rh if jacfun is not None else rh[0]).reshape(npt, 1)
+            rvv = 2/h*((rh - r)/h - _matvec(J, step))
+            # an infeasible probe point leaves the plain step
+            accel = None
+            if np.isfinite(rvv).all():
+                tsolve = time()
+                accel = stepper.solve(lamb, D, rvv)
+                info["solve_time"] += time() - tsolve
+            if accel is not None and 2*norm(accel) <= GEODESIC_ALPHA*norm(step):
+                step = step + 0.5*accel
+                info["accelerated"] += 1
         trialp = (params + step.T)[0]
 
         # Check function value at trialp
-        trialr, trialJ = residfun(trialp)
-        trialrms = norm(trialr)/np.sqrt(npt)
+        if jacfun is None:
+            trialr, trialJ = residfun(trialp)
+        else:
+            trialr = residfun(trialp)
+        trialrms = norm(trialr)/np.sqrt(npoints)
         rmstraj.append(trialrms)
+        if damper.uses_gain:
+            # actual over predicted (by the linear model) reduction of |r|^2
+            predicted = npoints*rms**2 - norm(r + _matvec(J, step))**2
+            gain = npoints*(rms**2 - trialrms**2)/predicted if predicted > 0 else 0
 
         # Accept or reject trial params
-        if trialrms < rms:
+        steplamb = lamb
+        accepted = trialrms < rms
+        if accepted:
+            info["accepted"] += 1
             params = trialp
-            J = trialJ
+            J = trialJ if jacfun is None else jacfun(trialp)
             r = trialr
             rms = trialrms
-            maxgrad = norm(np.dot(r.T, J), np.inf)
+            maxgrad = norm(_gradient(J, r), np.inf)
             # dsp here so that all grad info is for updated point,
             # but lambda not yet updated
             if verbose:
@@ -162,24 +300,296 @@ def levenberg_marquardt(
             if maxgrad < tolgrad:
                 if verbose:
                     print("1st order optimality attained")
-                break
-
-            if prev_trial_accepted and itr > 1:
-                lamb = lamb/10
+                info["termination"] = "tolgrad"
+            else:
+                lamb = damper.accepted(lamb, gain if damper.uses_gain else None,
+                                       prev_trial_accepted and itr > 1)
 
             prev_trial_accepted = True
             params_updated = True
         else:
+            info["rejected"] += 1
             if verbose:
                 print(formatstr % (itr, trialrms, maxgrad, lamb, norm(step),
                                    max(diagJJ)/min(diagJJ)))
-            lamb = lamb*10
+            lamb = damper.rejected(lamb)
             prev_trial_accepted = False
             params_updated = False
 
+        stop = callback is not None and callback({
+            "iteration": itr, "params": params, "rms": rms,
+            "trial_rms": trialrms, "accepted": accepted, "lambda": steplamb,
+            "step_norm": norm(step), "time": time() - t,
+            "evaluate_time": info["evaluate_time"],
+            "solve_time": info["solve_time"]})
+        if info["termination"] is not None:
+            break
+        if stop:
+            if verbose:
+                print("Stopped by callback")
+            info["termination"] = "callback"
+            break
+
     assert len(rmstraj) == itr + 1
+    info["iterations"] = itr
     rmstraj = np.array(rmstraj)
     if verbose:
         print("Final RMS: " + repr(rms))
 
+    if full_output:
+        return params, rmstraj, info
     return params, rmstraj
+
+
+class _ClassicDamping:
+    """lambda times 10 after a rejected step, divided by 10 after the second
+    of consecutive accepted steps"""
+    uses_gain = False
+
+    @staticmethod
+    def accepted(lamb, _, consecutive):
+        """lambda after an accepted step"""
+        if consecutive:
+            lamb = lamb/10
+        return lamb
+
+    @staticmethod
+    def rejected(lamb):
+        """lambda after a rejected step"""
+        return lamb*10
+
+
+class _NielsenDamping:
+    """Nielsen's update: after an accepted step with gain ratio rho, lambda
+    is scaled by max(1/3, 1 - (2 rho - 1)^3), so good steps reduce it and
+    poor ones increase it; after a rejected step it is multiplied by nu,
+    which doubles with each consecutive rejection"""
+    uses_gain = True
+
+    def __init__(self):
+        self.nu = 2
+
+    def accepted(self, lamb, gain, _):
+        """lambda after an accepted step"""
+        self.nu = 2
+        return lamb*max(1/3, 1 - (2*gain - 1)**3)
+
+    def rejected(self, lamb):
+        """lambda after a rejected step"""
+        lamb = lamb*self.nu
+        self.nu *= 2
+        return lamb
+
+
+DAMPING_STRATEGIES = {
+    "classic": _ClassicDamping,
+    "nielsen": _NielsenDamping,
+}
+
+
+def _instrumented(residfun, jacfun, info):
+    """residfun and jacfun that count their calls and time in info"""
+    def timed(fun, keys):
+        def timed_fun(params):
+            t = time()
+            out = fun(params)
+            info["evaluate_time"] += time() - t
+            for key in keys:
+                info[key] += 1
+            return out
+        return timed_fun
+    if jacfun is None:  # residfun also builds the Jacobian
+        return timed(residfun, ("residual_evaluations", "jacobian_evaluations")), None
+    return (timed(residfun, ("residual_evaluations",)),
+            timed(jacfun, ("jacobian_evaluations",)))
+
+
+def _weighted(residfun, jacfun, sqrtw):
+    """residfun and jacfun with each residual scaled by sqrtw"""
+    if jacfun is None:
+        def weighted_residfun(params):
+            r, J = residfun(params)
+            return r*sqrtw, _scale_rows(J, sqrtw)
+        return weighted_residfun, None
+    return (lambda params: residfun(params)*sqrtw,
+            lambda params: _scale_rows(jacfun(params), sqrtw))
+
+
+def _scale_rows(J, s):
+    """diag(s) J of a dense, sparse or structured Jacobian"""
+    if issparse(J):
+        return diags(s).dot(J)
+    if hasattr(J, "scale_rows"):
+        return J.scale_rows(s)
+    return J*s[:, np.newaxis]
+
+
+def _damping_diagonal(J, scaling):
+    """Diagonal of the damping matrix D'D for the given scaling"""
+    if scaling == "levenberg":
+        return np.ones(J.shape[1])
+    return _column_sqnorms(J)
+
+
+def _matvec(J, v):
+    """J v (column vector) of a dense, sparse or structured Jacobian"""
+    if hasattr(J, "matvec"):
+        return J.matvec(v).reshape(-1, 1)
+    return np.asarray(J.dot(v)).reshape(-1, 1)
+
+
+def _column_sqnorms(J):
+    """diag(J'J) of a dense, sparse or structured Jacobian"""
+    if issparse(J):
+        return np.asarray(J.multiply(J).sum(0)).ravel()
+    if hasattr(J, "column_sqnorms"):
+        return J.column_sqnorms()
+    return sum(J*J, 0).T
+
+
+def _gradient(J, r):
+    """r'J of a dense, sparse or structured Jacobian"""
+    if issparse(J):
+        return J.T.dot(np.asarray(r).ravel())
+    if hasattr(J, "rmatvec"):
+        return J.rmatvec(r)
+    return np.dot(r.T, J)
+
+
+def _gram(J):
+    """J'J (dense) of a dense, sparse or structured Jacobian"""
+    if issparse(J):
+        return J.T.dot(J).toarray()
+    if hasattr(J, "gram"):
+        return J.gram()
+    return np.dot(J.T, J)
+
+
+# pylint: disable=invalid-name
+class _LstsqStep:
+    """Solves the augmented system [J; D] step = [-r; 0] with lstsq"""
+    def __init__(self, npt, nparam):
+        self.npt, self.nparam = npt, nparam
+        self.augJ = self.augr = None
+
+    def update(self, J, r, _):
+        """Builds the augmented system for a new point"""
+        if hasattr(J, "toarray"):
+            J = J.toarray()
+        self.augJ = np.vstack((J, np.zeros((self.nparam, self.nparam))))
+        self.augr = np.vstack((-r, np.zeros((self.nparam, 1))))
+
+    def solve(self, _, D, r=None):
+        """Step for damping matrix D (and residual r, if not the point's)"""
+        self.augJ[self.npt:, :] = D.toarray() if issparse(D) else D
+        augr = self.augr if r is None else np.vstack((-r, np.zeros((self.nparam, 1))))
+        # Rank condition specified to default for python upgrades
+        return np.linalg.lstsq(self.augJ, augr, rcond=-1)[0]
+
+
+class _SVDStep:
+    """Reuses one SVD of the column-scaled Jacobian for every lambda
+
+    With S = diag(sqrt(diag(J'J))) and J S^-1 = U diag(s) V', the damped
+    step minimizing |J step + r|^2 + lambda |S step|^2 is
+    step = -S^-1 V diag(s/(s^2 + lambda)) U'r.
+    """
+    def __init__(self, npt, nparam):
+        self.npt, self.nparam = npt, nparam
+        self.scale = self.s = self.U = self.Vt = self.Utr = None
+
+    def update(self, J, r, diagJJ):
+        """Factors the scaled Jacobian at a new point"""
+        scale = np.sqrt(np.asarray(diagJJ, dtype=float).ravel())
+        scale[scale == 0] = 1  # all-zero columns stay all-zero
+        if hasattr(J, "toarray"):
+            J = J.toarray()
+        self.U, self.s, self.Vt = np.linalg.svd(J/scale, full_matrices=False)
+        self.Utr = np.dot(self.U.T, r)
+        self.scale = scale.reshape(self.nparam, 1)
+
+    def solve(self, lamb, _, r=None):
+        """Step for damping parameter lamb (and residual r, if not the
+        point's)"""
+        coeffs = -self.s/(self.s**2 + lamb)
+        Utr = self.Utr if r is None else np.dot(self.U.T, r)
+        return np.dot(self.Vt.T, coeffs.reshape(-1, 1)*Utr)/self.scale
+
+
+class _CholeskyStep:
+    """Solves the column-scaled normal equations by Cholesky factorization
+
+    With S = diag(sqrt(diag(J'J))), solves (S^-1 J'J S^-1 + lambda I) S step
+    = -S^-1 J'r, which only involves nparam x nparam matrices. Falls back to
+    the augmented lstsq system when J'J is too ill-conditioned to factor.
+    """
+    def __init__(self, npt, nparam):
+        self.fallback = _LstsqStep(npt, nparam)
+        self.scale = self.JJ = self.Jr = self.J = self.r = None
+
+    def update(self, J, r, diagJJ):
+        """Forms the scaled normal equations at a new point"""
+        scale = np.sqrt(np.asarray(diagJJ, dtype=float).ravel())
+        scale[scale == 0] = 1  # all-zero columns stay all-zero
+        self.JJ = _gram(J)/np.outer(scale, scale)
+        self.Jr = _gradient(J, r).reshape(-1, 1)/scale.reshape(-1, 1)
+        self.scale = scale.reshape(-1, 1)
+        self.J, self.r = J, r
+        self.fallback.augJ = None
+
+    def solve(self, lamb, _, r=None):
+        """Step for damping parameter lamb (and residual r, if not the
+        point's)"""
+        A = self.JJ + lamb*np.eye(self.JJ.shape[0])
+        Jr = (self.Jr if r is None else
+              _gradient(self.J, r).reshape(-1, 1)/self.scale)
+        try:
+            return -cho_solve(cho_factor(A), Jr)/self.scale
+        except (LinAlgError, ValueError):  # not positive definite, or not finite
+            if self.fallback.augJ is None:
+                self.fallback.update(self.J, self.r, None)
+            D = np.diag(np.sqrt(lamb)*self.scale.ravel())
+            return self.fallback.solve(lamb, D, r)
+
+
+class _SparseStep:
+    """Solves the column-scaled normal equations of a sparse Jacobian
+
+    J'J keeps the sparsity of J (for MaxAffine it is block diagonal), so it
+    is factored with a sparse LU. If that fails, the equivalent damped least
+    squares problem min |J S^-1 t + r|^2 + lambda |t|^2 is solved with lsqr.
+    """
+    def __init__(self, _npt, nparam):
+        self.nparam = nparam
+        self.scale = self.Js = self.JJ = self.Jr = self.r = None
+
+    def update(self, J, r, diagJJ):
+        """Forms the scaled sparse normal equations at a new point"""
+        scale = np.sqrt(np.asarray(diagJJ, dtype=float).ravel())
+        scale[scale == 0] = 1  # all-zero columns stay all-zero
+        self.Js = csr_matrix(J).dot(diags(1/scale))
+        self.r = np.asarray(r).ravel()
+        self.JJ = self.Js.T.dot(self.Js).tocsc()
+        self.Jr = self.Js.T.dot(self.r)
+        self.scale = scale
+
+    def solve(self, lamb, _, r=None):
+        """Step for damping parameter lamb (and residual r, if not the
+        point's)"""
+        r = self.r if r is None else np.asarray(r).ravel()
+        Jr = self.Jr if r is self.r else self.Js.T.dot(r)
+        A = (self.JJ + lamb*identity(self.nparam, format="csc")).tocsc()
+        try:
+            t = -splu(A).solve(Jr)
+        except RuntimeError:
+            t = lsqr(self.Js, -r, damp=np.sqrt(lamb), atol=1e-12,
+                     btol=1e-12)[0]
+        return (t/self.scale).reshape(-1, 1)
+
+
+STEP_SOLVERS = {
+    "lstsq": _LstsqStep,
+    "svd": _SVDStep,
+    "cholesky": _CholeskyStep,
+    "sparse": _SparseStep,
+}
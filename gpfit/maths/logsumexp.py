@@ -1,15 +1,21 @@
 "Module for log-sum-exponential functions"
-from numpy import zeros, spacing, exp, log, tile
+from numpy import (zeros, spacing, exp, log, newaxis, empty_like, subtract,
+                   multiply, negative, divide, maximum, clip)
 
+# Maximum number of Newton iterations of lse_implicit
+NEWTON_MAXITER = 100
 
-# pylint: disable=too-many-locals
-def lse_implicit(x, alpha):
+
+# pylint: disable=too-many-locals,too-many-statements
+def lse_implicit(x, alpha, full_output=False, L0=None):
     """
     Implicit Log-sum-exponential function with derivatives
     - sums across the second dimension of x
     - returns one y for every row of x
     - lse_implicit is a mapping R^n --> R, where n number of dimensions
     - implementation: newton raphson steps to find f(x,y) = 0
+    - only rows that have not converged are iterated on; they are compacted
+      into contiguous buffers that are updated in place
 
     Arguments:
     ----------
@@ -19,6 +25,15 @@ def lse_implicit(x, alpha):
     alpha: 1D array [K] (K=number of terms)
         local softness parameter
 
+    full_output: bool
+        If True, also return the number of Newton iterations
+
+    L0: None or 1D numpy array [nPoints]
+        Initial guess for y - max(x) (e.g. from a previous solve with
+        similar x); defaults to 0. It is clipped to [0, log(K)/min(alpha)],
+        which holds the solution, and rows where it underflows every term
+        (or where it is not finite) are started from 0 instead
+
     Returns:
     --------
     y: 1D numpy array [nPoints]
@@ -29,6 +44,10 @@ def lse_implicit(x, alpha):
 
     dydalpha: 2D array [nPoints x nDim]
 
+    niter: int (only if full_output)
+        Number of Newton iterations taken by the slowest row (at most
+        NEWTON_MAXITER)
+
     """
 
     tol = 10*spacing(1)
@@ -37,45 +56,83 @@ def lse_implicit(x, alpha):
     if nx != alpha.size:
         raise ValueError("alpha size mismatch")
 
-    alphamat = tile(alpha, (npt, 1))
-
     m = x.max(1)  # maximal x values
     # distance from m; note h <= 0 for all entries
-    h = x - (tile(m, (nx, 1))).T
-    L = zeros((npt,))  # initial guess. note y = m + L
-    Lmat = (tile(L, (nx, 1))).T
-
+    h = x - m[:, newaxis]
     # initial eval
-    expo = exp(alphamat*(h - Lmat))
-    alphaexpo = alphamat*expo
+    if L0 is None:
+        L = zeros((npt,))  # initial guess. note y = m + L
+        expo = exp(alpha*h)
+    else:
+        L = clip(L0, 0, log(nx)/alpha.min())
+        expo = exp(alpha*(h - L[:, newaxis]))
+        # restart from 0 where every term underflows (or L0 is not finite)
+        restart = ~(expo.sum(axis=1) > 0)
+        if restart.any():
+            L[restart] = 0
+            expo[restart] = exp(alpha*h[restart])
+    alphaexpo = alpha*expo
     sumexpo = expo.sum(axis=1)
     sumalphaexpo = alphaexpo.sum(axis=1)
     f = log(sumexpo)
-    dfdL = -alphaexpo.sum(axis=1)/sumexpo
-    neval = 1
-    i = abs(f) > tol  # inds to update
-
-    while any(i):
-        L[i] = L[i] - f[i]/dfdL[i]  # newton step
+    dfdL = -sumalphaexpo/sumexpo
+    niter = 0
+
+    # compact the rows that still need updating
+    active = (abs(f) > tol).nonzero()[0]
+    hA, LA, fA, dfdLA = h[active], L[active], f[active], dfdL[active]
+    expoA, alphaexpoA = empty_like(hA), empty_like(hA)
+    sumexpoA, sumalphaexpoA = empty_like(LA), empty_like(LA)
+
+    while active.size and niter < NEWTON_MAXITER:
+        LA -= fA/dfdLA  # newton step
+        # f is convex and decreasing in L, so only a step from above the
+        # solution can overshoot; it never goes below 0
+        maximum(LA, 0, out=LA)
         # re-evaluate
-        Lmat[i, :] = (tile(L[i], (nx, 1))).T
-        expo[i, :] = exp(alphamat[i, :]*(h[i, :] - Lmat[i, :]))
-        alphaexpo[i, :] = alphamat[i, :]*expo[i, :]
-        sumexpo[i] = expo[i, :].sum(axis=1)
-        sumalphaexpo[i, ] = alphaexpo[i, :].sum(axis=1)
-        f[i] = log(sumexpo[i])
-        dfdL[i] = -sumalphaexpo[i, ]/sumexpo[i]
-        neval = neval + 1
-        i[i] = abs(f[i]) > tol  # update inds that need to be evaluated
+        subtract(hA, LA[:, newaxis], out=expoA)
+        multiply(expoA, alpha, out=expoA)
+        exp(expoA, out=expoA)
+        multiply(expoA, alpha, out=alphaexpoA)
+        expoA.sum(axis=1, out=sumexpoA)
+        alphaexpoA.sum(axis=1, out=sumalphaexpoA)
+        log(sumexpoA, out=fA)
+        negative(sumalphaexpoA, out=dfdLA)
+        dfdLA /= sumexpoA
+        niter += 1
+
+        done = abs(fA) <= tol
+        if done.any():
+            # write converged rows back and drop them from the buffers
+            rows = active[done]
+            L[rows] = LA[done]
+            expo[rows] = expoA[done]
+            alphaexpo[rows] = alphaexpoA[done]
+            sumalphaexpo[rows] = sumalphaexpoA[done]
+            keep = ~done
+            active, hA, LA, fA, dfdLA = (active[keep], hA[keep], LA[keep],
+                                         fA[keep], dfdLA[keep])
+            expoA, alphaexpoA = expoA[keep], alphaexpoA[keep]
+            sumexpoA, sumalphaexpoA = sumexpoA[keep], sumalphaexpoA[keep]
+    if active.size:  # not converged within NEWTON_MAXITER
+        L[active] = LA
+        expo[active] = expoA
+        alphaexpo[active] = alphaexpoA
+        sumalphaexpo[active] = sumalphaexpoA
 
     y = m + L
-    dydx = alphaexpo/(tile(sumalphaexpo, (nx, 1))).T
-    dydalpha = (h - Lmat)*expo/(tile(sumalphaexpo, (nx, 1))).T
-
+    sumalphaexpo = sumalphaexpo[:, newaxis]
+    dydx = divide(alphaexpo, sumalphaexpo, out=alphaexpo)
+    dydalpha = subtract(h, L[:, newaxis], out=h)
+    dydalpha *= expo
+    dydalpha /= sumalphaexpo
+
+    if full_output:
+        return y, dydx, dydalpha, niter
     return y, dydx, dydalpha
 
 
-def lse_scaled(x, alpha):
+def lse_scaled(x, alpha, overwrite_x=False):
     """
     Log-sum-exponential function with derivatives
     - sums across the second dimension of x
@@ -89,6 +146,9 @@ def lse_scaled(x, alpha):
     alpha: 1D array [K] (K=number of terms)
         local softness parameter
 
+    overwrite_x: bool
+        If True, x is used as scratch space and its contents are destroyed
+
     Returns:
     --------
     y: 1D numpy array [nPoints]
@@ -101,15 +161,16 @@ def lse_scaled(x, alpha):
 
     """
 
-    _, n = x.shape
     m = x.max(axis=1)  # maximal x values
-    h = x - (tile(m, (n, 1))).T  # distance from m; note h <= 0 for all entries
-    expo = exp(alpha*h)
+    # distance from m; note h <= 0 for all entries
+    h = subtract(x, m[:, newaxis], out=x if overwrite_x else None)
+    expo = multiply(alpha, h)
+    exp(expo, out=expo)
     sumexpo = expo.sum(axis=1)
     L = log(sumexpo)/alpha
     y = L + m
-    dydx = expo/(tile(sumexpo, (n, 1))).T
+    dydalpha = ((multiply(h, expo, out=h)).sum(axis=1)/sumexpo - L)/alpha
+    dydx = divide(expo, sumexpo[:, newaxis], out=expo)
     # note that sum(dydx,2)==1, i.e. dydx is a probability distribution
-    dydalpha = ((h*expo).sum(axis=1)/sumexpo - L)/alpha
 
     return y, dydx, dydalpha
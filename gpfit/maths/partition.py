@@ -0,0 +1,147 @@
+"Implements max_affine_partition, a partition-refinement max-affine solver"
+from time import time
+import numpy as np
+from numpy.linalg import lstsq
+from .initialize import grow_partition
+
+
+# pylint: disable=too-many-locals,too-many-arguments,too-many-statements
+def max_affine_partition(x, y, initparams, weights=None, maxiter=100,
+                         verbose=False, full_output=False, callback=None):
+    """Fits a max-affine function by alternating between partitions and fits
+
+    Each iteration assigns every point to its active affine term and then
+    refits each term to its own points by linear least squares, until the
+    partition stops changing. As in get_initial_parameters, a partition
+    whose points do not determine its term (including an empty one) is
+    grown with the points closest to it, here those on which the term is
+    closest to active. The error is not guaranteed to decrease every
+    iteration, so the best parameters seen are returned.
+
+    Arguments
+    ---------
+    x: 2D numpy array [nPoints x nDim]
+        Independent variable data
+
+    y: 1D numpy array [nPoints]
+        Dependent variable data
+
+    initparams: 1D numpy array [K*(nDim + 1)]
+        Initial parameters, laid out as MaxAffine params
+
+    weights: None or 1D numpy array [nPoints]
+        Nonnegative weight of each point's squared residual
+
+    maxiter: int
+        Maximum number of refits
+
+    verbose: bool
+        If True, print the RMS error and number of reassigned points per
+        iteration
+
+    full_output: bool
+        If True, also return a report of the solve
+
+    callback: None or function
+        Called after every refit with a dict of its "iteration" number, its
+        "params" and their "rms", the number of "reassigned" points, and the
+        elapsed "time", "evaluate_time" and "solve_time" (seconds). If it
+        returns True, the solve stops
+
+    Returns
+    -------
+    params: 1D numpy array [K*(nDim + 1)]
+        Parameters with the lowest error seen
+
+    rmstraj: 1D numpy array
+        RMS error after each refit (first point is initialization)
+
+    info: dict (only if full_output)
+        Report of the solve, with the keys of levenberg_marquardt's: the
+        "termination" reason ("converged" once the partition is stable,
+        "maxiter" or "callback"), the number of "iterations" (refits), of
+        "residual_evaluations", the time spent evaluating the affine
+        functions ("evaluate_time") and in the refits ("solve_time"); there
+        are no Jacobians, and every refit counts as an accepted step
+
+    """
+    t = time()
+    info = {"termination": "maxiter", "iterations": 0, "accepted": 0,
+            "rejected": 0, "accelerated": 0, "residual_evaluations": 0,
+            "jacobian_evaluations": 0, "evaluate_time": 0., "solve_time": 0.}
+    sqrtw = None
+    if weights is not None:  # zero-weight points do not affect the fit
+        keep = weights > 0
+        x, y, sqrtw = x[keep], y[keep], np.sqrt(weights[keep])
+    npt, dimx = x.shape
+    X = np.hstack((np.ones((npt, 1)), x))
+    ba = np.reshape(initparams, (dimx + 1, -1), order="F")
+    K = ba.shape[1]
+
+    def evaluate(ba):
+        """Affine outputs, active terms and RMS error of parameters ba"""
+        tevaluate = time()
+        info["residual_evaluations"] += 1
+        z = np.dot(X, ba)
+        partition = z.argmax(1)
+        r = z[np.arange(npt), partition] - y
+        if sqrtw is not None:
+            r *= sqrtw
+        info["evaluate_time"] += time() - tevaluate
+        return z, partition, np.sqrt(np.dot(r, r)/npt)
+
+    z, partition, rms = evaluate(ba)
+    rmstraj = [rms]
+    best = (rmstraj[0], ba)
+    if verbose:
+        print("  Iter        RMS err        Reassigned")
+        print(f"{0:6d}        {rmstraj[0]:9.6g}")
+
+    for itr in range(1, maxiter + 1):
+        tsolve = time()
+        ba = np.empty((dimx + 1, K))
+        for k in range(K):
+            inds = partition == k
+            solution, rank = _local_fit(X, y, sqrtw, inds)
+            if rank < dimx + 1:
+                # nearest first: the points where term k is closest to active
+                gap = z[np.arange(npt), partition] - z[:, k]
+                grow_partition(X, inds, gap.argsort())
+                solution, _ = _local_fit(X, y, sqrtw, inds)
+            ba[:, k] = solution
+        info["solve_time"] += time() - tsolve
+
+        z, newpartition, rms = evaluate(ba)
+        rmstraj.append(rms)
+        if rmstraj[-1] < best[0]:
+            best = (rmstraj[-1], ba)
+        reassigned = np.count_nonzero(newpartition != partition)
+        if verbose:
+            print(f"{itr:6d}        {rmstraj[-1]:9.6g}        {reassigned:10d}")
+        info["iterations"] = info["accepted"] = itr
+        stop = callback is not None and callback({
+            "iteration": itr, "params": ba.flatten("F"), "rms": rms,
+            "reassigned": reassigned, "time": time() - t,
+            "evaluate_time": info["evaluate_time"],
+            "solve_time": info["solve_time"]})
+        if not reassigned:
+            info["termination"] = "converged"
+            break
+        if stop:
+            info["termination"] = "callback"
+            break
+        partition = newpartition
+
+    if full_output:
+        return best[1].flatten("F"), np.array(rmstraj), info
+    return best[1].flatten("F"), np.array(rmstraj)
+
+
+def _local_fit(X, y, sqrtw, inds):
+    """Least squares affine fit, and its rank, to the points in inds"""
+    rows = inds.nonzero()[0]
+    Xk, yk = X[rows], y[rows]
+    if sqrtw is not None:
+        Xk, yk = sqrtw[rows, np.newaxis]*Xk, sqrtw[rows]*yk
+    solution, _, rank, _ = lstsq(Xk, yk, rcond=-1)
+    return solution, rank
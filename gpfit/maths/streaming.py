@@ -0,0 +1,225 @@
+"Implements least squares problems whose data is streamed or split between processes"
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+# Data views of a ParallelLeastSquares worker process, set by _attach
+_WORKER = {}
+
+
+# pylint: disable=too-many-arguments,too-many-locals,too-many-instance-attributes
+def normal_equations(evaluate_y, evaluate_jacobian, x, y, params, chunksize,
+                     jacobian=True, weights=None):
+    """
+    Sum of squared residuals, and J'J and J'r, accumulated over chunks of
+    points
+
+    Arguments
+    ---------
+    evaluate_y, evaluate_jacobian, x, y, chunksize, weights:
+        As for StreamedLeastSquares
+
+    params: 1D numpy array
+        Fit parameters
+
+    jacobian: bool
+        If False, only the sum of squared residuals is computed
+
+    Returns
+    -------
+    rss: float
+        |r|^2 (r'Wr, with weights W)
+
+    JJ: 2D numpy array [nParams x nParams] (None if not jacobian)
+        J'J (J'WJ)
+
+    Jr: 1D numpy array [nParams] (None if not jacobian)
+        J'r (J'Wr)
+
+    """
+    nparam = params.size
+    rss = 0.
+    JJ, Jr = (np.zeros((nparam, nparam)), np.zeros(nparam)) if jacobian else (None, None)
+    for start in range(0, y.shape[0], chunksize):
+        rows = slice(start, start + chunksize)
+        yhat, cache = evaluate_y(np.asarray(x[rows]), params)
+        r = yhat - y[rows]
+        w = None if weights is None else np.asarray(weights[rows])
+        wr = r if w is None else w*r
+        rss += np.dot(wr, r)
+        if jacobian:
+            J = evaluate_jacobian(cache)
+            JJ += np.dot(J.T, J if w is None else w[:, np.newaxis]*J)
+            Jr += np.dot(wr, J)
+    return rss, JJ, Jr
+
+
+class StreamedLeastSquares:
+    """
+    Residual and Jacobian functions for levenberg_marquardt that stream the
+    data in chunks, so that memory use does not grow with the number of
+    points.
+
+    At an accepted point, J'J and J'r are accumulated chunk by chunk and
+    the problem is compressed to nparam + 1 rows: with J'J = R'R and
+    J'r = R'q, the residual [q; sqrt(|r|^2 - |q|^2)] and Jacobian [R; 0]
+    have the same norm, gradient and normal equations as the full ones, so
+    every step solver computes the same step. Trial points only need |r|^2,
+    which is one pass without Jacobians.
+
+    Because levenberg_marquardt only calls jacfun right after residfun at
+    the same parameters, the compressed residual returned by residual is
+    completed in place by jacobian; its norm is the same before and after.
+
+    Arguments
+    ---------
+    evaluate_y: function
+        (y, cache) = evaluate_y(x, params), as _Fit._evaluate_y
+
+    evaluate_jacobian: function
+        Dense dydp = evaluate_jacobian(cache), as _Fit._evaluate_jacobian
+
+    x: 2D array [nPoints x nDim]
+        Independent variable data; may be a memmap
+
+    y: 1D array [nPoints]
+        Dependent variable data; may be a memmap
+
+    chunksize: int
+        Number of points evaluated at once
+
+    weights: None or 1D array [nPoints]
+        Nonnegative weight of each point's squared residual; may be a memmap
+    """
+
+    def __init__(self, evaluate_y, evaluate_jacobian, x, y, chunksize,
+                 weights=None):
+        self.evaluate_y, self.evaluate_jacobian = evaluate_y, evaluate_jacobian
+        self.x, self.y = x, y
+        self.chunksize = chunksize
+        self.weights = weights
+        self.npt = y.shape[0]
+        self._last = None  # (params, compressed residual)
+
+    def _normal_equations(self, params, jacobian=True):
+        """normal_equations over all of the data"""
+        return normal_equations(self.evaluate_y, self.evaluate_jacobian,
+                                self.x, self.y, params, self.chunksize, jacobian,
+                                self.weights)
+
+    def residual(self, params):
+        """Compressed residual, with the norm of the full residual"""
+        rss = self._normal_equations(params, jacobian=False)[0]
+        r = np.zeros(params.size + 1)
+        r[-1] = np.sqrt(rss)
+        self._last = (params.copy(), r)
+        return r
+
+    def jacobian(self, params):
+        """Compressed Jacobian, completing the last compressed residual"""
+        if self._last is None or not np.array_equal(self._last[0], params):
+            self.residual(params)
+        r = self._last[1].reshape(-1)  # levenberg_marquardt may reshape it
+        nparam = params.size
+        rss, JJ, Jr = self._normal_equations(params)
+        # J'J = R'R with R = diag(sqrt(w)) V'; J'r lies in the range of J'J
+        w, V = np.linalg.eigh(JJ)
+        keep = w > max(w.max(), 0)*nparam*np.finfo(float).eps
+        R = np.zeros((nparam + 1, nparam))
+        R[:nparam][keep] = np.sqrt(w[keep])[:, np.newaxis]*V[:, keep].T
+        q = np.zeros(nparam)
+        q[keep] = np.dot(V[:, keep].T, Jr)/np.sqrt(w[keep])
+        r[:nparam] = q
+        r[-1] = np.sqrt(max(rss - np.dot(q, q), 0))
+        return R
+
+
+class ParallelLeastSquares(StreamedLeastSquares):
+    """
+    StreamedLeastSquares whose passes over the data are split between
+    worker processes
+
+    The data is copied once into shared memory, and each worker holds views
+    of it, so only the parameters are sent per pass. Each pass gives every
+    worker a contiguous shard of the points, whose normal_equations the
+    parent process adds up. Use as a context manager (or call close) to
+    stop the workers and free the shared memory.
+
+    Arguments
+    ---------
+    evaluate_y, evaluate_jacobian, x, y, chunksize, weights:
+        As for StreamedLeastSquares; evaluate_y and evaluate_jacobian must
+        be picklable (e.g. the static methods of a fit class)
+
+    workers: int
+        Number of worker processes
+    """
+
+    def __init__(self, evaluate_y, evaluate_jacobian, x, y, chunksize, workers,
+                 weights=None):
+        super().__init__(evaluate_y, evaluate_jacobian, x, y, chunksize, weights)
+        self._shared, specs, self.pool = [], [], None
+        try:
+            for data in (x, y) if weights is None else (x, y, weights):
+                shm = SharedMemory(create=True, size=max(data.nbytes, 1))
+                self._shared.append(shm)
+                np.ndarray(data.shape, data.dtype, buffer=shm.buf)[...] = data
+                specs.append((shm.name, data.shape, data.dtype))
+            bounds = np.linspace(0, self.npt, workers + 1).astype(int)
+            self.shards = [(start, stop)
+                           for start, stop in zip(bounds[:-1], bounds[1:])
+                           if stop > start]
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers, initializer=_attach,
+                initargs=(evaluate_y, evaluate_jacobian, specs, chunksize))
+        except BaseException:
+            self.close()
+            raise
+
+    def _normal_equations(self, params, jacobian=True):
+        """normal_equations of each shard, reduced"""
+        parts = list(self.pool.map(_shard_normal_equations,
+                                   [(params, start, stop, jacobian)
+                                    for start, stop in self.shards]))
+        rss = sum(part[0] for part in parts)
+        if not jacobian:
+            return rss, None, None
+        return rss, sum(part[1] for part in parts), sum(part[2] for part in parts)
+
+    def close(self):
+        """Stops the workers and frees the shared memory"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for shm in self._shared:
+            shm.close()
+            shm.unlink()
+        self._shared = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _attach(evaluate_y, evaluate_jacobian, specs, chunksize):
+    """Initializes a ParallelLeastSquares worker with views of the data"""
+    _WORKER["shared"] = [SharedMemory(name=name) for name, _, _ in specs]
+    arrays = [np.ndarray(shape, dtype, buffer=shm.buf)
+              for shm, (_, shape, dtype) in zip(_WORKER["shared"], specs)]
+    _WORKER["x"], _WORKER["y"] = arrays[:2]
+    _WORKER["weights"] = arrays[2] if len(arrays) > 2 else None
+    _WORKER["functions"] = (evaluate_y, evaluate_jacobian)
+    _WORKER["chunksize"] = chunksize
+
+
+def _shard_normal_equations(args):
+    """normal_equations of one shard, in a ParallelLeastSquares worker"""
+    params, start, stop, jacobian = args
+    evaluate_y, evaluate_jacobian = _WORKER["functions"]
+    weights = _WORKER["weights"]
+    return normal_equations(evaluate_y, evaluate_jacobian,
+                            _WORKER["x"][start:stop], _WORKER["y"][start:stop],
+                            params, _WORKER["chunksize"], jacobian,
+                            None if weights is None else weights[start:stop])
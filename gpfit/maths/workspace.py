@@ -0,0 +1,52 @@
+"Implements Workspace, buffers shared by evaluations at fixed x"
+import numpy as np
+
+
+class Workspace:
+    """
+    Intermediates that stay fixed, and buffers that can be reused, while a
+    fit is evaluated at the same x over many solver iterations.
+
+    Only arrays that are consumed within one evaluation (affine function
+    values) or replaced at every accepted point (the dense Jacobian) are
+    kept in buffers; anything a structured Jacobian may still reference
+    is allocated afresh.
+
+    Arguments
+    ---------
+    x: 2D numpy array [nPoints x nDim]
+        Independent variable data
+
+    Attributes
+    ----------
+    X: 2D numpy array [nPoints x (nDim + 1)]
+        x augmented with a leading column of ones
+
+    lse_guess: None or 1D numpy array [nPoints]
+        Solution y - max(z) of the lse_implicit solve at the last accepted
+        point (the last one whose Jacobian was evaluated), used as the
+        initial guess for the next solves
+
+    lse_trial: None or 1D numpy array [nPoints]
+        Solution y - max(z) of the last lse_implicit solve, which becomes
+        lse_guess once its point is accepted; rejected trial points (e.g.
+        with a tiny sharpness) can be far from the next ones
+    """
+
+    def __init__(self, x):
+        npt = x.shape[0]
+        self.X = np.hstack((np.ones((npt, 1)), x))
+        self.lse_guess = self.lse_trial = None
+        self._buffers = {}
+
+    def buffer(self, name, shape):
+        """Uninitialized float array, reused by later calls with the same
+        name and shape"""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self._buffers[name] = np.empty(shape)
+        return buf
+
+    def affine(self, ba):
+        """z = X ba, written into the "z" buffer"""
+        return np.dot(self.X, ba, out=self.buffer("z", (self.X.shape[0], ba.shape[1])))
@@ -0,0 +1,75 @@
+"""unit tests for gpfit.maths.backends module"""
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from gpfit.maths.backends import BACKENDS, scipy_least_squares
+from gpfit.maths.least_squares import levenberg_marquardt
+
+
+def expfun(params):
+    "Residual of an exponential decay fit, with its Jacobian."
+    times = np.arange(0.0, 4.0, 0.25)
+    model = params[0]*np.exp(-params[1]*times)
+    r = model - (2*np.exp(-1.5*times) + 0.01*(-1)**np.arange(times.size))
+    return r, np.vstack((model/params[0], -times*model)).T
+
+
+class TestScipyLeastSquares(unittest.TestCase):
+    """scipy.optimize.least_squares as a levenberg_marquardt stand-in"""
+
+    initparams = np.array([1., 2.])
+    params = levenberg_marquardt(expfun, initparams)[0]
+
+    def test_methods(self):
+        for method in ["trf", "lm"]:
+            params, rmstraj = scipy_least_squares(expfun, self.initparams,
+                                                  method=method)
+            self.assertTrue(np.allclose(params, self.params, atol=1e-6))
+            self.assertEqual(rmstraj[0], np.sqrt(np.mean(expfun(self.initparams)[0]**2)))
+            self.assertTrue(rmstraj.min() < rmstraj[0])
+
+    def test_jacfun(self):
+        for backend in BACKENDS.values():
+            params, _ = backend(lambda p: expfun(p)[0], self.initparams,
+                                jacfun=lambda p: csr_matrix(expfun(p)[1]))
+            self.assertTrue(np.allclose(params, self.params, atol=1e-6))
+
+    def test_weights(self):
+        weights = np.arange(16) % 3 + 1.
+        params_lm = levenberg_marquardt(expfun, self.initparams, weights=weights)[0]
+        params = scipy_least_squares(expfun, self.initparams, weights=weights)[0]
+        self.assertTrue(np.allclose(params, params_lm, atol=1e-6))
+
+    def test_options(self):
+        _, rmstraj = scipy_least_squares(expfun, self.initparams, maxiter=2)
+        self.assertTrue(rmstraj.size <= 3)
+        params, _ = scipy_least_squares(expfun, self.initparams, tolrms=1e-12,
+                                        x_scale=1.0, gtol=None, xtol=None)
+        self.assertTrue(np.allclose(params, self.params, atol=1e-6))
+
+    def test_callback(self):
+        reports = []
+        _, rmstraj, info = scipy_least_squares(expfun, self.initparams,
+                                               full_output=True,
+                                               callback=reports.append)
+        self.assertEqual(len(reports), info["iterations"] + 1)
+        self.assertEqual(info["residual_evaluations"], rmstraj.size)
+        self.assertEqual(info["accepted"] + info["rejected"], rmstraj.size - 1)
+        params, _, info = scipy_least_squares(
+            expfun, self.initparams, full_output=True,
+            callback=lambda report: report["iteration"] == 2)
+        self.assertEqual(info["termination"], "callback")
+        self.assertEqual(info["iterations"], 2)
+        self.assertTrue(np.allclose(params, reports[2]["params"]))
+
+
+TESTS = [TestScipyLeastSquares]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
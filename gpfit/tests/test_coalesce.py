@@ -0,0 +1,49 @@
+"""unit tests for gpfit.maths.coalesce module"""
+import unittest
+import numpy as np
+from gpfit.maths.coalesce import coalesce
+
+
+class TestCoalesce(unittest.TestCase):
+    """Merging of repeated points"""
+
+    x = np.array([[1., 2.], [1., 2.], [3., 4.], [1., 2.05]])
+    y = np.array([1., 3., 5., 7.])
+
+    def test_duplicates(self):
+        x, y, weights = coalesce(self.x, self.y)
+        self.assertEqual(x.shape, (3, 2))
+        self.assertTrue((weights == [2, 1, 1]).all())
+        self.assertTrue((y == [2, 7, 5]).all())
+
+    def test_weights(self):
+        x, y, weights = coalesce(self.x, self.y, np.array([1., 0., 1., 2.]))
+        self.assertEqual(x.shape, (3, 2))
+        self.assertTrue((weights == [1, 2, 1]).all())
+        self.assertTrue((y == [1, 7, 5]).all())
+
+    def test_tol(self):
+        x, y, weights = coalesce(self.x, self.y, tol=0.5)
+        self.assertTrue((weights == [3, 1]).all())
+        self.assertTrue(np.allclose(x[0], [1, (2*2 + 2.05)/3]))
+        self.assertTrue(np.allclose(y, [11/3, 5]))
+
+    def test_squared_error(self):
+        # weighted sum of squares differs by a constant
+        x, y, weights = coalesce(self.x, self.y)
+        yhat, yhat_merged = self.x.sum(1), x.sum(1)
+        offsets = [np.sum((yhat + c - self.y)**2)
+                   - np.dot(weights, (yhat_merged + c - y)**2) for c in (0, 1)]
+        self.assertAlmostEqual(offsets[0], offsets[1])
+
+
+TESTS = [TestCoalesce]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
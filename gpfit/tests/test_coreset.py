@@ -0,0 +1,51 @@
+"""unit tests for gpfit.maths.coreset module"""
+import unittest
+import numpy as np
+from gpfit.maths.coreset import coreset
+
+
+class TestCoreset(unittest.TestCase):
+    """Weighted samples of the data"""
+
+    rng = np.random.RandomState(0)
+    x = rng.uniform(size=(2000, 2))**2  # denser near the origin
+    y = x.sum(1)
+
+    def test_stratified(self):
+        x, y, weights = coreset(self.x, self.y, 200, seed=0)
+        self.assertTrue(150 < y.size < 300)
+        self.assertAlmostEqual(weights.sum(), self.y.size)
+        self.assertTrue((x.sum(1) == y).all())
+        # sparse regions are kept
+        self.assertTrue(x.max(0).min() > 0.8)
+
+    def test_importance(self):
+        scores = (self.x[:, 0] > 0.5).astype(float)
+        x, _, weights = coreset(self.x, self.y, 200, seed=0, scores=scores)
+        self.assertTrue(100 < weights.size <= 200)
+        self.assertTrue(np.mean(x[:, 0] > 0.5) > 0.5)
+        # weighted sums stay unbiased
+        self.assertTrue(abs(weights.sum()/self.y.size - 1) < 0.2)
+        self.assertTrue(abs(np.dot(weights, x[:, 0] > 0.5)/scores.sum() - 1) < 0.2)
+
+    def test_weights(self):
+        weights = np.where(self.x[:, 0] > 0.5, 3., 1.)
+        _, _, wcore = coreset(self.x, self.y, 200, seed=0, weights=weights)
+        self.assertAlmostEqual(wcore.sum(), weights.sum())
+
+    def test_small_data(self):
+        x, y, weights = coreset(self.x, self.y, 5000)
+        self.assertTrue(x is self.x and y is self.y)
+        self.assertTrue((weights == 1).all())
+
+
+TESTS = [TestCoreset]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
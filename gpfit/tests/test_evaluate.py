@@ -1,6 +1,7 @@
 "Test evaluate methods"
 import unittest
 from numpy import arange, newaxis
+from scipy.sparse import issparse
 from gpfit.fit import MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine
 
 
@@ -24,6 +25,14 @@ class TestMaxAffine(unittest.TestCase):
     def test_dydba_ndim(self):
         self.assertEqual(self.dydba.ndim, 2)
 
+    def test_sparse_dydba(self):
+        # pylint: disable=protected-access
+        y, cache = MaxAffine._evaluate_y(self.x, self.ba)
+        dydba = MaxAffine._evaluate_jacobian(cache, "sparse")
+        self.assertTrue(issparse(dydba))
+        self.assertTrue((y == self.y).all())
+        self.assertTrue((dydba.toarray() == self.dydba).all())
+
 
 class TestSoftmaxAffine(unittest.TestCase):
     "Tests softmax_affine"
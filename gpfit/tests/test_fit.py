@@ -3,13 +3,17 @@ import unittest
 import pickle
 import sys
 from io import StringIO
-from numpy import logspace, log10, log, vstack
-from gpfit.fit import fit, MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine
+from tempfile import TemporaryDirectory
+from numpy.lib.format import open_memmap
+from numpy import logspace, log10, log, exp, vstack, save, arange
+from gpfit.fit import (fit, fit_multistart, fit_sweep, fit_coreset, MaxAffine,
+                       SoftmaxAffine, ImplicitSoftmaxAffine)
+from gpfit.maths.workspace import Workspace
 
 SEED = 33404
 
 
-class TestFit(unittest.TestCase):
+class TestFit(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """Test fit class"""
 
     u = logspace(0, log10(3), 101)
@@ -72,9 +76,293 @@ class TestFit(unittest.TestCase):
             "  + (0.961596/w^0.116677)*(u_1)^-0.0112199"
         ))
 
+    def test_solver_options(self):
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                solver_options={"step_solver": "svd"})
+        self.assertTrue(f.errors["rms_rel"] < 1e-4)
+
+    def test_sparse_jacobian(self):
+        f = fit(self.x, self.y, self.K, fit_type="ma", seed=SEED,
+                jacobian_type="sparse")
+        self.assertEqual(f.__repr__(), (
+            "w = 0.807159*(u_1)^-0.0703921\n"
+            "w = 0.995106*(u_1)^-0.431386\n"
+            "w = 0.92288*(u_1)^-0.247099"
+        ))
+
+    def test_partition_solver(self):
+        f1 = fit(self.x, self.y, self.K, fit_type="ma", seed=SEED)
+        f2 = fit(self.x, self.y, self.K, fit_type="ma", seed=SEED,
+                 solver="partition", solver_options={"maxiter": 50})
+        self.assertTrue(f2.errors["rms_rel"] < 1.01*f1.errors["rms_rel"])
+        self.assertEqual(f2.refit(self.x, self.y).solver, "partition")
+        f3 = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED, chain=True,
+                 solver="partition")
+        self.assertTrue(f3.errors["rms_rel"] < 1e-4)
+        with self.assertRaises(ValueError):
+            SoftmaxAffine(self.x, self.y, self.K, solver="partition")
+        with self.assertRaises(ValueError):
+            MaxAffine(self.x, self.y, self.K, solver="partition", chunksize=10)
+
+    def test_scipy_solvers(self):
+        for solver in ["scipy-trf", "scipy-lm"]:
+            f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                    solver=solver)
+            self.assertTrue(f.errors["rms_rel"] < 1e-4)
+        f = fit(self.x, self.y, self.K, fit_type="ma", seed=SEED,
+                solver="scipy-trf", jacobian_type="sparse")
+        self.assertTrue(f.errors["rms_rel"] < 1e-2)
+        f = fit(self.x, self.y, self.K, seed=SEED, solver="scipy-trf",
+                jacobian_type="structured")
+        self.assertTrue(f.errors["rms_rel"] < 1e-5)
+        with self.assertRaises(ValueError):
+            MaxAffine(self.x, self.y, self.K, solver="scipy-trf", chunksize=10)
+
+    def test_homotopy_solver(self):
+        for jacobian_type in SoftmaxAffine.jacobian_types:
+            f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                    solver="homotopy", jacobian_type=jacobian_type)
+            self.assertTrue(f.errors["rms_rel"] < 1e-4)
+        # refits keep the warm start instead of restarting the continuation
+        f2 = f.refit(self.x, 1.01*self.y)
+        self.assertEqual(f2.solver, "lm")
+        self.assertEqual(f2.solve_report["stages"], [])
+        self.assertEqual(f.refit(self.x, self.y, solver="homotopy").solver,
+                         "homotopy")
+        with self.assertRaises(ValueError):
+            ImplicitSoftmaxAffine(self.x, self.y, self.K, solver="homotopy")
+
+    def test_solve_report(self):
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED)
+        report = f.solve_report
+        self.assertEqual(report["solver"], "lm")
+        self.assertEqual(report["stages"], [])
+        self.assertTrue(report["termination"] in ("tolrms", "tolgrad"))
+        self.assertEqual(report["rmstraj"].size, report["iterations"] + 1)
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                solver="homotopy")
+        softness = [stage["softness"] for stage in f.solve_report["stages"]]
+        self.assertTrue(softness == sorted(softness))
+        self.assertTrue("softness" not in f.solve_report)
+        f = MaxAffine(self.x, self.y, self.K, batchsize=20)
+        self.assertTrue(len(f.solve_report["stages"]) > 0)
+
+    def test_callback(self):
+        reports = []
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                callback=reports.append)
+        self.assertEqual(len(reports), f.solve_report["iterations"])
+        for solver in ["lm", "homotopy", "scipy-trf"]:
+            f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                    solver=solver, callback=lambda report: report["iteration"] == 1)
+            self.assertEqual(f.solve_report["termination"], "callback")
+            self.assertTrue(f.solve_report["stages"] == [])
+        reports = []
+        f = fit(self.x, self.y, self.K, fit_type="isma", seed=SEED, chain=True,
+                callback=lambda report: reports.append(report) or True)
+        self.assertEqual(f.type, "MaxAffine")
+        self.assertEqual(len(reports), 1)
+        self.assertTrue(pickle.loads(pickle.dumps(f)).solve_report["termination"]
+                        == "callback")
+
+    def test_structured_jacobian(self):
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED,
+                jacobian_type="structured")
+        self.assertTrue(f.errors["rms_rel"] < 1e-4)
+        f = fit(self.x, self.y, self.K, seed=SEED, jacobian_type="structured")
+        self.assertTrue(f.errors["rms_rel"] < 1e-5)
+
+    def test_fit_chain(self):
+        f = fit(self.x, self.y, self.K, fit_type="sma", seed=SEED, chain=True)
+        self.assertEqual(f.type, "SoftmaxAffine")
+        self.assertTrue(f.errors["rms_rel"] < 1e-4)
+        f = fit(self.x, self.y, self.K, seed=SEED, chain=True,
+                jacobian_type="structured")
+        self.assertEqual(f.type, "ImplicitSoftmaxAffine")
+        self.assertTrue(f.errors["rms_rel"] < 1e-5)
+
+    def test_fit_multistart(self):
+        f1, errors1 = fit_multistart(self.x, self.y, self.K, nstarts=3,
+                                     seed=SEED, processes=1, fit_type="sma")
+        f2, errors2 = fit_multistart(self.x, self.y, self.K, nstarts=3,
+                                     seed=SEED, processes=2, fit_type="sma")
+        self.assertEqual(errors1.shape, (3,))
+        self.assertTrue((errors1 == errors2).all())
+        self.assertEqual(f1.error, min(errors1))
+        self.assertEqual(f1.__repr__(), f2.__repr__())
+
+    def test_fit_sweep(self):
+        best, fits = fit_sweep(self.x, self.y, 3, fit_type="sma", seed=SEED)
+        self.assertEqual([f.K for f in fits], list(range(1, len(fits) + 1)))
+        self.assertIn(best, fits)
+        self.assertTrue(best.errors["rms_rel"] < 1e-4)
+        # one more affine term, and the same softness
+        params0 = best.split_params()
+        self.assertEqual(params0.size, best.params.size + best.d + 1)
+        self.assertEqual(params0[-1], best.params[-1])
+
+    def test_params0(self):
+        f1 = SoftmaxAffine(self.x, self.y, self.K, seed=SEED)
+        f2 = SoftmaxAffine(self.x, self.y, self.K, params0=f1.params)
+        self.assertTrue(f2.errors["rms_rel"] <= f1.errors["rms_rel"])
+        with self.assertRaises(ValueError):
+            SoftmaxAffine(self.x, self.y, self.K, params0=f1.params[:-1])
+
+    def test_refit(self):
+        f1 = ImplicitSoftmaxAffine(self.x, self.y, self.K, seed=SEED)
+        f2 = f1.refit(self.x, 1.01*self.y)
+        self.assertEqual(f2.type, f1.type)
+        self.assertEqual(f2.K, f1.K)
+        self.assertTrue(f2.errors["rms_rel"] < 1e-5)
+        f3 = ImplicitSoftmaxAffine(self.x, 1.01*self.y, self.K, params0=f1)
+        self.assertTrue((f3.params == f2.params).all())
+        with self.assertRaises(ValueError):
+            SoftmaxAffine(self.x, self.y, self.K, params0=f1)
+
+    def test_workspace(self):
+        # pylint: disable=protected-access
+        for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+            f = fitclass(self.x, self.y, self.K, seed=SEED)
+            self.assertIsNone(f._workspace)
+            workspace = Workspace(f.xdata)
+            y, dydp = f.evaluate(f.xdata, f.params)
+            for _ in range(2):
+                y1, cache = f._evaluate_y(f.xdata, f.params, workspace)
+                dydp1 = f._evaluate_jacobian(cache, "dense", workspace)
+                self.assertTrue(abs(y1 - y).max() < 1e-12)
+                self.assertTrue(abs(dydp1 - dydp).max() < 1e-12)
+            if fitclass is ImplicitSoftmaxAffine:
+                self.assertEqual(workspace.lse_guess.shape, y.shape)
+
+    def test_workspace_rejected_trial(self):
+        # pylint: disable=protected-access
+        # a rejected trial with a tiny sharpness does not become the guess
+        f = ImplicitSoftmaxAffine(self.x, self.y, self.K, seed=SEED)
+        workspace = Workspace(f.xdata)
+        y = f._evaluate_y(f.xdata, f.params)[0]
+        f._evaluate_jacobian(f._evaluate_y(f.xdata, f.params, workspace)[1],
+                             "dense", workspace)
+        guess = workspace.lse_guess
+        trial = f.params.copy()
+        trial[-self.K:] = 1e-6
+        f._evaluate_y(f.xdata, trial, workspace)
+        self.assertTrue(workspace.lse_guess is guess)
+        y1 = f._evaluate_y(f.xdata, f.params, workspace)[0]
+        self.assertTrue(abs(y1 - y).max() < 1e-12)
+
+    def test_predict(self):
+        for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+            f = fitclass(self.x, self.y, self.K, seed=SEED)
+            y = f.evaluate(f.xdata, f.params)[0]
+            self.assertTrue(abs(f.predict_log(self.x) - y).max() < 1e-12)
+            self.assertTrue(abs(f.predict_log(self.x, chunksize=7) - y).max() < 1e-12)
+            self.assertTrue(abs(f.predict(self.u) - exp(y)).max() < 1e-12)
+            self.assertTrue(abs(f.predict_log(self.x, return_w=True)
+                                - exp(y)).max() < 1e-12)
+            with self.assertRaises(ValueError):
+                f.predict_log(vstack((self.x, self.x)))
+
+    def test_evaluate_chunked(self):
+        for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+            f = fitclass(self.x, self.y, self.K, seed=SEED)
+            y, dydp = f.evaluate(f.xdata, f.params)
+            y1 = f.evaluate_chunked(f.xdata, f.params, chunksize=10)
+            self.assertTrue(abs(y1 - y).max() < 1e-12)
+            with TemporaryDirectory() as tmpdir:
+                out = open_memmap(f"{tmpdir}/y.npy", "w+", shape=y.shape)
+                jac_out = open_memmap(f"{tmpdir}/dydp.npy", "w+", shape=dydp.shape)
+                y2, dydp2 = f.evaluate_chunked(f.xdata, f.params, jacobian=True,
+                                               out=out, jac_out=jac_out,
+                                               max_bytes=2**12, max_workers=3)
+                self.assertTrue(y2 is out and dydp2 is jac_out)
+                self.assertTrue(abs(y2 - y).max() < 1e-12)
+                self.assertTrue(abs(dydp2 - dydp).max() < 1e-12)
+                del out, jac_out, y2, dydp2
+
+    def test_streaming(self):
+        with TemporaryDirectory() as tmpdir:
+            save(f"{tmpdir}/x.npy", self.x)
+            save(f"{tmpdir}/y.npy", self.y)
+            for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+                f1 = fitclass(self.x, self.y, self.K, seed=SEED)
+                f2 = fitclass(f"{tmpdir}/x.npy", f"{tmpdir}/y.npy", self.K,
+                              params0=f1, chunksize=16)
+                self.assertTrue(f2.errors["rms_rel"] <= 1.01*f1.errors["rms_rel"])
+                f3 = fitclass(self.x, self.y, self.K, seed=SEED, chunksize=16)
+                self.assertTrue(f3.errors["rms_rel"] < 1e-2)
+                # RMS over all of the points, not the compressed residual;
+                # the last trial may have been rejected
+                self.assertAlmostEqual(f3.solve_report["rmstraj"].min(),
+                                       f3.errors["rms_log"], places=10)
+                del f2
+            # trial residuals are compressed to their norm
+            with self.assertRaises(ValueError):
+                SoftmaxAffine(self.x, self.y, self.K, chunksize=16,
+                              solver_options={"geodesic": True})
+            with self.assertRaises(ValueError):
+                SoftmaxAffine(self.x, self.y, self.K, workers=2,
+                              solver_options={"geodesic": True})
+        # errors accumulated over chunks
+        f1.chunksize = 7
+        errors = f1._compute_errors()  # pylint: disable=protected-access
+        for key, error in f1.errors.items():
+            self.assertAlmostEqual(errors[key], error)
+
+    def test_workers(self):
+        f1 = SoftmaxAffine(self.x, self.y, self.K, seed=SEED)
+        f2 = SoftmaxAffine(self.x, self.y, self.K, seed=SEED, workers=2)
+        self.assertAlmostEqual(f2.errors["rms_rel"], f1.errors["rms_rel"], places=5)
+        self.assertAlmostEqual(f2.solve_report["rmstraj"].min(),
+                               f2.errors["rms_log"], places=10)
+        self.assertEqual(f2.refit(self.x, self.y).workers, 2)
+        f3 = MaxAffine(self.x.astype("float32"), self.y.astype("float32"),
+                       self.K, seed=SEED, workers=2)
+        self.assertTrue(f3.errors["rms_rel"] < 1e-2)
+
+    def test_batchsize(self):
+        for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+            f1 = fitclass(self.x, self.y, self.K, seed=SEED)
+            f2 = fitclass(self.x, self.y, self.K, seed=SEED, batchsize=10)
+            self.assertTrue(f2.errors["rms_rel"] < max(1e-3, 2*f1.errors["rms_rel"]))
+            self.assertEqual(f2.refit(self.x, self.y).batchsize, 10)
+
+    def test_weights(self):
+        # repeated points and integer weights give the same fit
+        weights = arange(self.x.size) % 3 + 1.
+        xrep = self.x.repeat(weights.astype(int))
+        yrep = self.y.repeat(weights.astype(int))
+        for fitclass in (MaxAffine, SoftmaxAffine, ImplicitSoftmaxAffine):
+            f1 = fitclass(xrep, yrep, self.K, seed=SEED)
+            f2 = fitclass(self.x, self.y, self.K, params0=f1.params, weights=weights)
+            self.assertTrue(abs(f2.params - f1.params).max() < 1e-3)
+            for key, error in f1.errors.items():
+                self.assertAlmostEqual(f2.errors[key], error, places=5)
+        f3 = fit(xrep, yrep, self.K, "isma", seed=SEED, coalesce_tol=0)
+        self.assertEqual(f3.ydata.size, self.y.size)
+        self.assertTrue((f3.weights == weights).all())
+        with self.assertRaises(ValueError):
+            MaxAffine(self.x, self.y, self.K, weights=-weights)
+
+    def test_fit_coreset(self):
+        f, report = fit_coreset(self.x, self.y, self.K, 40, fit_type="sma",
+                                seed=SEED, compare=True)
+        self.assertTrue(report["size"] < self.y.size)
+        self.assertEqual(report["errors"], f.errors_on(self.x, self.y))
+        # 40 of 101 points of a smooth curve cost only a few percent
+        self.assertTrue(report["penalty"] < 0.05)
+        f, report = fit_coreset(self.x, self.y, self.K, 40, fit_type="ma",
+                                method="importance", seed=SEED, polish=True)
+        self.assertEqual(f.ydata.size, self.y.size)
+        self.assertEqual(report["errors"], f.errors)
+        self.assertEqual(f.errors_on(self.x, self.y), f.errors)
+        with self.assertRaises(ValueError):
+            fit_coreset(self.x, self.y, self.K, 40, method="uniform")
+
     def test_incorrect_inputs(self):
         with self.assertRaises(ValueError):
             MaxAffine(self.x, vstack((self.y, self.y)), self.K)
+        with self.assertRaises(ValueError):
+            MaxAffine(self.x, self.y, self.K, jacobian_type="structured")
 
     def test_save_and_load(self):
         f1 = ImplicitSoftmaxAffine(self.x, self.y, self.K, seed=SEED)
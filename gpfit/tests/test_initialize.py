@@ -1,8 +1,12 @@
 "unit tests for get_initial_parameters function"
 import unittest
+import numpy as np
 from numpy import arange, newaxis, vstack, log, exp
 from numpy.random import random_sample
-from gpfit.maths.initialize import get_initial_parameters
+from numpy.linalg import matrix_rank
+from gpfit.maths import initialize
+from gpfit.maths.initialize import (get_initial_parameters, grow_partition,
+                                    squared_distances)
 
 
 class TestMaxAffineInitK2(unittest.TestCase):
@@ -47,7 +51,62 @@ class TestMaxAffineInitK4(unittest.TestCase):
         self.assertEqual(self.ba.shape, (3, 4))
 
 
-TESTS = [TestMaxAffineInitK2, TestMaxAffineInitK4]
+class TestKmeansppInit(unittest.TestCase):
+    "Tests k-means++ seeding"
+
+    rng = np.random.RandomState(33404)
+    x = rng.random_sample((500, 2))
+    y = log(exp(x).sum(1))[:, newaxis]
+
+    def test_ba_shape(self):
+        ba = get_initial_parameters(self.x, self.y, 5, seed=1, init="kmeans++")
+        self.assertEqual(ba.shape, (3, 5))
+
+    def test_reproducible(self):
+        ba1 = get_initial_parameters(self.x, self.y, 5, seed=1, init="kmeans++")
+        ba2 = get_initial_parameters(self.x, self.y, 5, seed=1, init="kmeans++")
+        self.assertTrue((ba1 == ba2).all())
+
+    def test_unknown_init(self):
+        with self.assertRaises(ValueError):
+            get_initial_parameters(self.x, self.y, 5, init="kmeans")
+
+
+class TestPartitionHelpers(unittest.TestCase):
+    "Tests squared_distances and grow_partition"
+
+    rng = np.random.RandomState(33404)
+
+    def test_squared_distances(self):
+        x = self.rng.random_sample((100, 3))
+        centers = x[:4]
+        direct = ((x[:, newaxis, :] - centers[newaxis])**2).sum(2)
+        self.assertTrue(np.allclose(squared_distances(x, centers), direct))
+
+    def test_grow_partition(self):
+        # gridded data with many repeated points, grown in small blocks
+        blocksize = initialize.BLOCKSIZE
+        initialize.BLOCKSIZE = 3
+        try:
+            for _ in range(20):
+                x = self.rng.randint(0, 3, (40, 2)).astype(float)
+                X = np.hstack((np.ones((40, 1)), x))
+                order = self.rng.permutation(40)
+                inds = np.zeros(40, dtype=bool)
+                inds[order[:2]] = True
+                expected = inds.copy()
+                for i in order[2:]:
+                    if matrix_rank(X[expected]) == 3:
+                        break
+                    expected[i] = True
+                grow_partition(X, inds, order)
+                self.assertTrue((inds == expected).all())
+        finally:
+            initialize.BLOCKSIZE = blocksize
+
+
+TESTS = [TestMaxAffineInitK2, TestMaxAffineInitK4, TestKmeansppInit,
+         TestPartitionHelpers]
 
 if __name__ == "__main__":
     SUITE = unittest.TestSuite()
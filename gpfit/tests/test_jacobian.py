@@ -0,0 +1,64 @@
+"unit tests for structured Jacobians"
+import unittest
+import numpy as np
+from gpfit.maths import jacobian
+from gpfit.maths.jacobian import KhatriRaoJacobian
+
+
+class TestKhatriRaoJacobian(unittest.TestCase):
+    "Tests KhatriRaoJacobian against the dense Jacobian"
+
+    rng = np.random.RandomState(33404)
+    npt, K, d = 50, 3, 2
+    dydz = rng.random_sample((npt, K))
+    X = np.hstack((np.ones((npt, 1)), rng.random_sample((npt, d))))
+    E = rng.random_sample((npt, K))
+    J = KhatriRaoJacobian(dydz, X, E)
+    repmat = np.tile(dydz, (d + 1, 1)).reshape(npt, K*(d + 1), order="F")
+    dense = np.hstack((repmat*np.tile(X, (1, K)), E))
+
+    def test_shape(self):
+        self.assertEqual(self.J.shape, self.dense.shape)
+
+    def test_toarray(self):
+        self.assertTrue((self.J.toarray() == self.dense).all())
+        out = np.empty(self.J.shape)
+        self.assertTrue(self.J.toarray(out=out) is out)
+        self.assertTrue((out == self.dense).all())
+
+    def test_matvec(self):
+        v = self.rng.random_sample(self.dense.shape[1])
+        self.assertTrue(np.allclose(self.J.matvec(v), self.dense.dot(v)))
+
+    def test_rmatvec(self):
+        r = self.rng.random_sample(self.npt)
+        self.assertTrue(np.allclose(self.J.rmatvec(r), self.dense.T.dot(r)))
+
+    def test_column_sqnorms(self):
+        self.assertTrue(np.allclose(self.J.column_sqnorms(),
+                                    (self.dense**2).sum(0)))
+
+    def test_gram(self):
+        self.assertTrue(np.allclose(self.J.gram(),
+                                    self.dense.T.dot(self.dense)))
+
+    def test_gram_chunked(self):
+        chunk_elements = jacobian.CHUNK_ELEMENTS
+        jacobian.CHUNK_ELEMENTS = 7*self.dense.shape[1]
+        try:
+            self.assertTrue(np.allclose(self.J.gram(),
+                                        self.dense.T.dot(self.dense)))
+        finally:
+            jacobian.CHUNK_ELEMENTS = chunk_elements
+
+
+TESTS = [TestKhatriRaoJacobian]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
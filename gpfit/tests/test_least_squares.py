@@ -1,7 +1,10 @@
 "Tests levenberg_marquardt"
 import unittest
-from numpy import arange, newaxis
-from gpfit.maths.least_squares import levenberg_marquardt
+from numpy import (arange, newaxis, ones, zeros, allclose, minimum, exp, vstack,
+                   diag, sqrt, mean)
+from scipy.sparse import csr_matrix
+from gpfit.maths.least_squares import (levenberg_marquardt, _CholeskyStep,
+                                       STEP_SOLVERS)
 from gpfit.fit import MaxAffine
 
 
@@ -12,6 +15,11 @@ def rfun(params):
     return r, drdp
 
 
+def jfun(params):
+    "Jacobian of rfun, evaluated separately."
+    return rfun(params)[1]
+
+
 class t_levenberg_marquardt(unittest.TestCase):
     "Tests levenberg_marquardt"
     initparams = arange(1.0, 5.0)
@@ -32,7 +40,190 @@ class t_levenberg_marquardt(unittest.TestCase):
         self.assertEqual(self.RMStraj.ndim, 1)
 
 
-TESTS = [t_levenberg_marquardt]
+class TestStepSolvers(unittest.TestCase):
+    "Tests the alternative step solvers of levenberg_marquardt"
+    initparams = arange(1.0, 5.0)
+    params, RMStraj = levenberg_marquardt(rfun, initparams)
+
+    def test_svd(self):
+        params, rmstraj = levenberg_marquardt(rfun, self.initparams,
+                                              step_solver="svd")
+        self.assertEqual(params.shape, self.initparams.shape)
+        self.assertAlmostEqual(rmstraj[-1], self.RMStraj[-1])
+
+    def test_cholesky(self):
+        params, rmstraj = levenberg_marquardt(rfun, self.initparams,
+                                              step_solver="cholesky")
+        self.assertEqual(params.shape, self.initparams.shape)
+        self.assertAlmostEqual(rmstraj[-1], self.RMStraj[-1])
+
+    def test_cholesky_fallback(self):
+        # rank deficient J with no damping cannot be Cholesky factored
+        J = ones((4, 2))
+        r = ones((4, 1))
+        stepper = _CholeskyStep(4, 2)
+        stepper.update(J, r, (J*J).sum(0))
+        step = stepper.solve(0, zeros((2, 2)))
+        self.assertTrue(allclose(J.dot(step), -r))
+
+    def test_jacfun(self):
+        jacparams = []
+
+        def counting_jfun(params):
+            jacparams.append(params)
+            return jfun(params)
+
+        params, rmstraj = levenberg_marquardt(lambda p: rfun(p)[0],
+                                              self.initparams,
+                                              jacfun=counting_jfun)
+        self.assertTrue((params == self.params).all())
+        self.assertTrue((rmstraj == self.RMStraj).all())
+        # the Jacobian is only built at the initial and accepted points
+        accepted = rmstraj[1:] < minimum.accumulate(rmstraj)[:-1]
+        self.assertEqual(len(jacparams), 1 + sum(accepted))
+
+    def test_sparse(self):
+        params, rmstraj = levenberg_marquardt(
+            lambda p: (rfun(p)[0], csr_matrix(rfun(p)[1])), self.initparams)
+        self.assertEqual(params.shape, self.initparams.shape)
+        self.assertAlmostEqual(rmstraj[-1], self.RMStraj[-1])
+
+    def test_weights(self):
+        # integer weights are equivalent to repeating points
+        x = arange(0.0, 16.0)[:, newaxis]
+        weights = arange(16) % 3 + 1.
+        xrep = x.repeat(weights.astype(int), axis=0)
+
+        def residual(params, x=x):
+            yhat, drdp = MaxAffine.evaluate(x, params)
+            return yhat - (x[:, 0] - 8)**2/8, drdp
+
+        params_rep = levenberg_marquardt(lambda p: residual(p, xrep),
+                                         self.initparams)[0]
+        params = levenberg_marquardt(residual, self.initparams, weights=weights)[0]
+        self.assertTrue(allclose(params, params_rep))
+        params = levenberg_marquardt(lambda p: residual(p)[0], self.initparams,
+                                     jacfun=lambda p: csr_matrix(residual(p)[1]),
+                                     weights=weights)[0]
+        self.assertTrue(allclose(params, params_rep))
+
+    def test_unknown_solver(self):
+        with self.assertRaises(ValueError):
+            levenberg_marquardt(rfun, self.initparams, step_solver="qr")
+
+
+def expfun(params):
+    "Residual of an exponential decay fit, with its Jacobian."
+    times = arange(0.0, 4.0, 0.25)
+    model = params[0]*exp(-params[1]*times)
+    r = model - (2*exp(-1.5*times) + 0.01*(-1)**arange(times.size))
+    return r, vstack((model/params[0], -times*model)).T
+
+
+class TestDamping(unittest.TestCase):
+    "Tests the damping strategies and geodesic acceleration"
+    initparams = arange(1.0, 3.0)
+    params, RMStraj = levenberg_marquardt(expfun, initparams)
+
+    def test_full_output(self):
+        params, rmstraj, info = levenberg_marquardt(expfun, self.initparams,
+                                                    full_output=True)
+        self.assertTrue((params == self.params).all())
+        self.assertTrue((rmstraj == self.RMStraj).all())
+        self.assertEqual(info["accepted"] + info["rejected"], rmstraj.size - 1)
+        self.assertEqual(info["accelerated"], 0)
+
+    def test_strategies(self):
+        for damping in ["classic", "nielsen"]:
+            for scaling in ["marquardt", "levenberg"]:
+                for geodesic in [False, True]:
+                    params, _, info = levenberg_marquardt(
+                        expfun, self.initparams, damping=damping,
+                        scaling=scaling, geodesic=geodesic, full_output=True)
+                    self.assertTrue(allclose(params, self.params, atol=1e-5))
+                    self.assertEqual(info["accelerated"] > 0, geodesic)
+
+    def test_geodesic_step_solvers(self):
+        for step_solver in STEP_SOLVERS:
+            if step_solver == "sparse":
+                params, _ = levenberg_marquardt(
+                    lambda p: expfun(p)[0], self.initparams,
+                    jacfun=lambda p: csr_matrix(expfun(p)[1]), geodesic=True)
+            else:
+                params, _ = levenberg_marquardt(expfun, self.initparams,
+                                                geodesic=True,
+                                                step_solver=step_solver)
+            self.assertTrue(allclose(params, self.params, atol=1e-5))
+
+    def test_geodesic_infeasible_probe(self):
+        # the residual is infinite (e.g. a nonpositive ISMA softness) at
+        # some probe points, where the plain step is taken
+        def barrier(params):
+            r, J = expfun(params)
+            return (r + float("inf"), J) if params[1] < 1.9 else (r, J)
+
+        for step_solver in ["lstsq", "svd", "cholesky"]:
+            params, rmstraj, info = levenberg_marquardt(
+                barrier, arange(1.0, 3.0), geodesic=True, maxiter=50,
+                step_solver=step_solver, full_output=True)
+            self.assertTrue(params[1] >= 1.9)
+            self.assertTrue(rmstraj.min() < rmstraj[0])
+            self.assertTrue(info["accelerated"] < info["iterations"])
+
+    def test_residual_override(self):
+        # solving with another residual equals updating with it
+        J = vstack((arange(4.0), ones(4), arange(4.0)**2)).T
+        r, r2 = ones((4, 1)), arange(4.0)[:, newaxis]
+        D = diag([0.1, 0.2, 0.3])
+        for stepper_class in STEP_SOLVERS.values():
+            stepper, stepper2 = stepper_class(4, 3), stepper_class(4, 3)
+            stepper.update(J, r, (J*J).sum(0))
+            stepper2.update(J, r2, (J*J).sum(0))
+            self.assertTrue(allclose(stepper.solve(0.5, D, r2),
+                                     stepper2.solve(0.5, D)))
+
+    def test_report(self):
+        _, rmstraj, info = levenberg_marquardt(expfun, self.initparams,
+                                               full_output=True)
+        self.assertTrue(info["termination"] in ("tolrms", "tolgrad"))
+        self.assertEqual(info["iterations"], rmstraj.size - 1)
+        self.assertEqual(info["residual_evaluations"], rmstraj.size)
+        self.assertEqual(info["jacobian_evaluations"], info["accepted"] + 1)
+        _, _, info = levenberg_marquardt(expfun, self.initparams, maxiter=3,
+                                         full_output=True)
+        self.assertEqual(info["termination"], "maxiter")
+
+    def test_npoints(self):
+        # the same solve, with the RMS error averaged over more points
+        params, rmstraj = levenberg_marquardt(expfun, self.initparams,
+                                              npoints=64)
+        self.assertTrue((params == self.params).all())
+        self.assertTrue(allclose(rmstraj, self.RMStraj/2))
+
+    def test_callback(self):
+        reports = []
+        _, rmstraj = levenberg_marquardt(expfun, self.initparams,
+                                         callback=reports.append)
+        self.assertEqual(len(reports), rmstraj.size - 1)
+        self.assertEqual([report["trial_rms"] for report in reports],
+                         list(rmstraj[1:]))
+        self.assertEqual(reports[-1]["rms"], rmstraj.min())
+        # stop after the second iteration
+        params, rmstraj, info = levenberg_marquardt(
+            expfun, self.initparams, full_output=True,
+            callback=lambda report: report["iteration"] == 2)
+        self.assertEqual(info["termination"], "callback")
+        self.assertEqual(rmstraj.size, 3)
+        self.assertTrue(allclose(sqrt(mean(expfun(params)[0]**2)), rmstraj.min()))
+
+    def test_unknown_options(self):
+        with self.assertRaises(ValueError):
+            levenberg_marquardt(expfun, self.initparams, damping="fletcher")
+        with self.assertRaises(ValueError):
+            levenberg_marquardt(expfun, self.initparams, scaling="moré")
+
+
+TESTS = [t_levenberg_marquardt, TestStepSolvers, TestDamping]
 
 if __name__ == "__main__":
     SUITE = unittest.TestSuite()
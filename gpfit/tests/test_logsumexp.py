@@ -2,7 +2,7 @@
 import unittest
 import numpy as np
 from numpy import array, arange
-from gpfit.maths.logsumexp import lse_implicit, lse_scaled
+from gpfit.maths.logsumexp import lse_implicit, lse_scaled, NEWTON_MAXITER
 
 
 class TestLSEimplicit1D(unittest.TestCase):
@@ -46,6 +46,48 @@ class TestLSEimplicit2D(unittest.TestCase):
     def test_dydalpha_shape(self):
         self.assertEqual(self.dydalpha.shape, self.x.shape)
 
+    def test_full_output(self):
+        y, dydx, dydalpha, niter = lse_implicit(self.x, self.alpha,
+                                                full_output=True)
+        self.assertTrue((y == self.y).all())
+        self.assertTrue((dydx == self.dydx).all())
+        self.assertTrue((dydalpha == self.dydalpha).all())
+        self.assertTrue(niter > 0)
+
+    def test_implicit_equation(self):
+        # y solves sum(exp(alpha*(x - y))) = 1 row by row
+        lhs = np.exp(self.alpha*(self.x - self.y[:, np.newaxis])).sum(1)
+        self.assertTrue(np.allclose(lhs, 1))
+
+    def test_warm_start(self):
+        # starting from the solution for slightly different alpha
+        L0 = self.y - self.x.max(1)
+        y, _, _, niter = lse_implicit(self.x, 1.01*self.alpha,
+                                      full_output=True)
+        y0, _, _, niter0 = lse_implicit(self.x, 1.01*self.alpha,
+                                        full_output=True, L0=L0)
+        self.assertTrue(np.allclose(y0, y, rtol=0, atol=1e-12))
+        self.assertTrue(niter0 <= niter)
+        # negative guesses are clipped to the lower bound max(x)
+        y0 = lse_implicit(self.x, self.alpha, L0=-np.ones(self.x.shape[0]))[0]
+        self.assertTrue(np.allclose(y0, self.y, rtol=0, atol=1e-12))
+
+    def test_stale_guess(self):
+        # guesses far above the solution (e.g. from a trial point with a tiny
+        # sharpness) must not stall Newton
+        x, alpha = np.array([[0., -1., -2.]]), np.array([10., 10., 10.])
+        y = lse_implicit(x, alpha)[0]
+        for L0 in [80., 1e300, np.inf, np.nan]:
+            y0, _, _, niter = lse_implicit(x, alpha, full_output=True,
+                                           L0=np.array([L0]))
+            self.assertTrue(np.allclose(y0, y, rtol=0, atol=1e-12))
+            self.assertTrue(niter < NEWTON_MAXITER)
+        # every term underflows at the upper end of the bracket
+        alpha = np.array([1e-3, 1e3, 10.])
+        y0 = lse_implicit(x, alpha, L0=np.array([80.]))[0]
+        self.assertTrue(np.allclose(y0, lse_implicit(x, alpha)[0], rtol=0,
+                                    atol=1e-12))
+
 
 class TestLSEScaled(unittest.TestCase):
     "Test lse_implicit"
@@ -72,6 +114,13 @@ class TestLSEScaled(unittest.TestCase):
     def test_dydalpha_size(self):
         self.assertEqual(self.dydalpha.size, self.x.shape[0])
 
+    def test_overwrite_x(self):
+        x = self.x.copy()
+        y, dydx, dydalpha = lse_scaled(x, self.alpha, overwrite_x=True)
+        self.assertTrue((y == self.y).all())
+        self.assertTrue((dydx == self.dydx).all())
+        self.assertTrue((dydalpha == self.dydalpha).all())
+
     # test alpha is integer? negative? 0? array?
 
 
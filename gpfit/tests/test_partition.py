@@ -0,0 +1,64 @@
+"""unit tests for gpfit.maths.partition module"""
+import unittest
+import numpy as np
+from gpfit.maths.partition import max_affine_partition
+
+
+class TestMaxAffinePartition(unittest.TestCase):
+    """Alternating partition least squares"""
+
+    x = np.linspace(-1, 1, 41)[:, np.newaxis]
+    y = np.maximum(-x[:, 0], 2*x[:, 0] - 0.5)
+
+    def test_exact(self):
+        params, rmstraj = max_affine_partition(self.x, self.y,
+                                               np.array([0., -1., 0., 1.]))
+        self.assertTrue(rmstraj[-1] < 1e-12)
+        self.assertTrue(np.allclose(params, [0, -1, -0.5, 2]))
+        self.assertTrue(rmstraj.size < 10)
+
+    def test_empty_partition(self):
+        # the second term starts inactive everywhere and is regrown
+        params, rmstraj = max_affine_partition(self.x, self.y,
+                                               np.array([0., -1., -10., 0.]))
+        self.assertTrue(rmstraj[-1] < rmstraj[0])
+        self.assertEqual(params.size, 4)
+        self.assertTrue(np.isfinite(params).all())
+
+    def test_weights(self):
+        weights = np.ones(self.y.size)
+        weights[::2] = 0
+        params, _ = max_affine_partition(self.x, self.y, np.array([0., -1., 0., 1.]),
+                                         weights=weights)
+        self.assertTrue(np.allclose(params, [0, -1, -0.5, 2]))
+
+    def test_maxiter(self):
+        _, rmstraj = max_affine_partition(self.x, self.y, np.array([0., -1., 0., 1.]),
+                                          maxiter=1)
+        self.assertEqual(rmstraj.size, 2)
+
+    def test_callback(self):
+        reports = []
+        _, rmstraj, info = max_affine_partition(
+            self.x, self.y, np.array([0., -1., -10., 0.]), full_output=True,
+            callback=reports.append)
+        self.assertEqual(info["termination"], "converged")
+        self.assertEqual(len(reports), info["iterations"])
+        self.assertEqual([report["rms"] for report in reports], list(rmstraj[1:]))
+        _, rmstraj, info = max_affine_partition(
+            self.x, self.y, np.array([0., -1., -10., 0.]), full_output=True,
+            callback=lambda report: True)
+        self.assertEqual(info["termination"], "callback")
+        self.assertEqual(rmstraj.size, 2)
+
+
+TESTS = [TestMaxAffinePartition]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
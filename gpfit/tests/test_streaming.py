@@ -0,0 +1,99 @@
+"""unit tests for gpfit.maths.streaming module"""
+import unittest
+import numpy as np
+from gpfit.classes import SoftmaxAffine
+from gpfit.maths.streaming import StreamedLeastSquares, ParallelLeastSquares
+
+
+class TestStreamedLeastSquares(unittest.TestCase):
+    """Compressed problem has the normal equations of the full one"""
+
+    rng = np.random.RandomState(0)
+    x = rng.rand(50, 2)
+    y = rng.rand(50)
+    params = np.hstack((rng.randn(9), 0.5))
+
+    # pylint: disable=protected-access
+    yhat, cache = SoftmaxAffine._evaluate_y(x, params)
+    r = yhat - y
+    J = SoftmaxAffine._evaluate_jacobian(cache)
+    problem = StreamedLeastSquares(SoftmaxAffine._evaluate_y,
+                                   SoftmaxAffine._evaluate_jacobian, x, y, 7)
+
+    def test_residual_norm(self):
+        rc = self.problem.residual(self.params)
+        self.assertEqual(rc.size, self.params.size + 1)
+        self.assertAlmostEqual(np.linalg.norm(rc), np.linalg.norm(self.r))
+
+    def test_normal_equations(self):
+        rc = self.problem.residual(self.params)
+        Jc = self.problem.jacobian(self.params)
+        self.assertEqual(Jc.shape, (self.params.size + 1, self.params.size))
+        self.assertAlmostEqual(np.linalg.norm(rc), np.linalg.norm(self.r))
+        self.assertTrue(np.allclose(Jc.T.dot(Jc), self.J.T.dot(self.J)))
+        self.assertTrue(np.allclose(Jc.T.dot(rc), self.J.T.dot(self.r)))
+
+    def test_weights(self):
+        weights = self.rng.rand(self.y.size)
+        # pylint: disable=protected-access
+        problem = StreamedLeastSquares(SoftmaxAffine._evaluate_y,
+                                       SoftmaxAffine._evaluate_jacobian,
+                                       self.x, self.y, 7, weights)
+        rss, JJ, Jr = problem._normal_equations(self.params)
+        self.assertAlmostEqual(rss, np.dot(weights, self.r**2))
+        self.assertTrue(np.allclose(JJ, self.J.T.dot(weights[:, np.newaxis]*self.J)))
+        self.assertTrue(np.allclose(Jr, self.J.T.dot(weights*self.r)))
+
+    def test_jacobian_first(self):
+        Jc = self.problem.jacobian(2*self.params)
+        self.assertEqual(Jc.shape, (self.params.size + 1, self.params.size))
+
+
+class TestParallelLeastSquares(unittest.TestCase):
+    """Shards reduce to the normal equations of the whole data"""
+
+    x, y, params = TestStreamedLeastSquares.x, TestStreamedLeastSquares.y, \
+        TestStreamedLeastSquares.params
+    serial = TestStreamedLeastSquares.problem
+
+    def test_normal_equations(self):
+        # pylint: disable=protected-access
+        with ParallelLeastSquares(SoftmaxAffine._evaluate_y,
+                                  SoftmaxAffine._evaluate_jacobian,
+                                  self.x, self.y, 7, 3) as problem:
+            self.assertEqual(len(problem.shards), 3)
+            rss, JJ, Jr = problem._normal_equations(self.params)
+            self.assertIsNone(problem._normal_equations(self.params, False)[1])
+        rss0, JJ0, Jr0 = self.serial._normal_equations(self.params)
+        self.assertAlmostEqual(rss, rss0)
+        self.assertTrue(np.allclose(JJ, JJ0))
+        self.assertTrue(np.allclose(Jr, Jr0))
+
+    def test_dtypes(self):
+        # shared copies keep the dtype of the data
+        x, y = self.x.astype(np.float32), self.y.astype(np.float32)
+        weights = np.arange(self.y.size) % 3
+        # pylint: disable=protected-access
+        with ParallelLeastSquares(SoftmaxAffine._evaluate_y,
+                                  SoftmaxAffine._evaluate_jacobian,
+                                  x, y, 7, 2, weights) as problem:
+            rss, JJ, Jr = problem._normal_equations(self.params)
+        serial = StreamedLeastSquares(SoftmaxAffine._evaluate_y,
+                                      SoftmaxAffine._evaluate_jacobian,
+                                      x, y, 7, weights)
+        rss0, JJ0, Jr0 = serial._normal_equations(self.params)
+        self.assertAlmostEqual(rss, rss0)
+        self.assertTrue(np.allclose(JJ, JJ0))
+        self.assertTrue(np.allclose(Jr, Jr0))
+
+
+TESTS = [TestStreamedLeastSquares, TestParallelLeastSquares]
+
+if __name__ == "__main__":
+    SUITE = unittest.TestSuite()
+    LOADER = unittest.TestLoader()
+
+    for t in TESTS:
+        SUITE.addTests(LOADER.loadTestsFromTestCase(t))
+
+    unittest.TextTestRunner(verbosity=2).run(SUITE)